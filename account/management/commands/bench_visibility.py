@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from account.models import Class, ClassStudent, RoleStudent, User
+from account.models.choices import ClassTypeChoice, UserRoleChoice
+from account.views.user import UserViewSet
+
+
+class Command(BaseCommand):
+    help = "比较用户在 1 个和多个班级中时 /users/ 列表的查询，测试数据在事务中创建，结束后回滚"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--classes", type=int, nargs="+", default=[1, 20], help="用户所在的班级数")
+        parser.add_argument("--size", type=int, default=40, help="每个班级的学生数")
+        parser.add_argument("--repeat", type=int, default=20, help="每种情况的重复次数")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options["classes"], options["size"], options["repeat"])
+            transaction.set_rollback(True)
+
+    def create_user(self, nickname):
+        user = User.objects.create(nickname=nickname, name=nickname[:16], role=UserRoleChoice.STUDENT)
+        return RoleStudent.objects.create(user=user)
+
+    def get_list_queryset(self, user):
+        """
+        :return: UserViewSet 的 list 实际使用的查询集（包括 PermissionFilter），不分页
+        """
+        request = APIRequestFactory().get("/users/")
+        force_authenticate(request, user)
+        view = UserViewSet(action_map={"get": "list"}, kwargs={}, format_kwarg=None)
+        view.request = view.initialize_request(request)
+        return view.filter_queryset(view.get_queryset())
+
+    def run(self, counts, size, repeat):
+        shapes = {}
+        for n in counts:
+            role = self.create_user(f"bench-{n}")
+            for i in range(n):
+                klass = Class.objects.create(name=f"B{i:04d}", created=2000, type=ClassTypeChoice.ADMINISTRATIVE)
+                students = [self.create_user(f"bench-{n}-{i}-{j}") for j in range(size)]
+                ClassStudent.objects.bulk_create(
+                    [ClassStudent(classes=klass, user_role=student) for student in students + [role]]
+                )
+            queryset = self.get_list_queryset(role.user)
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    visible = len(list(queryset.all()))
+                elapsed = (time.perf_counter() - start) / repeat
+            sql, _ = queryset.query.sql_with_params()
+            shapes[n] = sql
+            self.stdout.write(
+                f"{n} 个班级：可见 {visible} 人，每次 {len(queries) // repeat} 条查询，"
+                f"SQL {len(sql)} 字符，{elapsed * 1000:.2f}ms"
+            )
+        if len(set(shapes.values())) == 1:
+            self.stdout.write(self.style.SUCCESS("不同班级数的 SQL 完全相同"))
+        else:
+            self.stdout.write(self.style.WARNING("不同班级数的 SQL 不同"))
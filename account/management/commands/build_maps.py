@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from account.maps import build_class_maps
+from account.models import Class
+from destination.conf import settings as destination_settings
+from destination.utils.geo import district_cache
+from destination.utils.maps import MAP_FORMATS, build_map_assets
+
+
+class Command(BaseCommand):
+    help = "一次性生成多个班级的去向地图"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--class", dest="classes", action="append", help="班级id，默认为所有开启地图的班级")
+        parser.add_argument("--graduated", type=int, help="只生成该年毕业的班级")
+        parser.add_argument("--type", dest="class_type", help="只生成该类型的班级")
+        parser.add_argument("--detail", dest="details", action="append", choices=list(destination_settings.MAP_DETAILS),
+                            help="细节等级，默认为 MAP_DEFAULT_DETAIL")
+        parser.add_argument("--format", dest="formats", action="append", choices=list(MAP_FORMATS),
+                            help="地图格式，默认为 geojson")
+        parser.add_argument("--districts", action="store_true", help="同时生成所有行政区下钻时使用的地图")
+        parser.add_argument("-p", "--processes", type=int, default=os.cpu_count(), help="进程数")
+
+    def handle(self, *args, **options):
+        queryset = Class.objects.all()
+        if options["classes"]:
+            queryset = queryset.filter(pk__in=options["classes"])
+        else:
+            queryset = queryset.filter(map_activated=True)
+        if options["graduated"] is not None:
+            queryset = queryset.filter(graduated=options["graduated"])
+        if options["class_type"]:
+            queryset = queryset.filter(type=options["class_type"])
+        class_ids = list(queryset.values_list("pk", flat=True))
+        if not class_ids:
+            raise CommandError("没有需要生成地图的班级")
+
+        # 底图和行政区地图的接口只发送已生成的文件
+        assets = build_map_assets(
+            options["details"] or [destination_settings.MAP_DEFAULT_DETAIL],
+            options["formats"] or ["geojson"],
+            districts=options["districts"],
+        )
+        self.stdout.write(f"底图和行政区地图共 {assets} 个文件")
+        result = build_class_maps(
+            class_ids,
+            details=options["details"],
+            formats=options["formats"] or ["geojson"],
+            processes=options["processes"],
+        )
+        seconds = result["seconds"]
+        self.stdout.write(self.style.SUCCESS(
+            f"已生成 {result['classes']} 个班级的 {result['files']} 个地图文件，"
+            f"共 {result['bytes'] / 1024 / 1024:.1f}MB，耗时 {seconds:.2f}s，"
+            f"{result['classes'] / seconds:.1f} 班级/s，{result['bytes'] / 1024 / 1024 / seconds:.1f}MB/s"
+        ))
+        stats = district_cache.stats()
+        self.stdout.write(
+            f"行政区缓存：命中 {stats['hits']} 次，未命中 {stats['misses']} 次，淘汰 {stats['evictions']} 次，"
+            f"{stats['entries']} 个文件共 {stats['bytes'] / 1024 / 1024:.1f}MB"
+        )
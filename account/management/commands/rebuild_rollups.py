@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from account.models import DestinationRollup
+
+
+class Command(BaseCommand):
+    help = "重新统计年级和学校的去向汇总表"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--graduated", type=int, help="只统计该年毕业的班级，0 表示没有毕业年份的班级")
+        parser.add_argument("--type", dest="class_type", help="只统计该类型的班级")
+
+    def handle(self, *args, **options):
+        DestinationRollup.rebuild(options["graduated"], options["class_type"])
+        self.stdout.write(self.style.SUCCESS(f"汇总表共 {DestinationRollup.objects.count()} 行"))
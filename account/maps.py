@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+批量生成班级地图
+
+边界只读取、编码一次，所有班级的去向用一次按 (班级, 城市, 学校) 分组的查询统计，
+渲染和写文件分给进程池，缓存和数据库只在主进程中更新。
+"""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.cache import cache
+from django.db import connections, models
+
+from account.models import Class, ClassStudent
+from destination.conf import settings as destination_settings
+from destination.utils.geo import aggregate_destination_counts
+from destination.utils.maps import iter_class_map, prepare_class_maps
+
+# 子进程通过 fork 继承主进程中已经编码好的底图
+_prepared = {}
+
+
+def get_classes_destination_counts(class_ids):
+    """
+    :return: {class_id: aggregate_destination_counts 的结果}
+    """
+    rows = (
+        ClassStudent.objects.filter(classes_id__in=class_ids)
+        .values("classes_id", "user_role__city__adcode", "user_role__school_id")
+        .annotate(count=models.Count("pk"))
+        .order_by()
+    )
+    grouped = {class_id: [] for class_id in class_ids}
+    for row in rows:
+        grouped[row["classes_id"]].append({
+            "city__adcode": row["user_role__city__adcode"],
+            "school_id": row["user_role__school_id"],
+            "count": row["count"],
+        })
+    return {class_id: aggregate_destination_counts(class_rows) for class_id, class_rows in grouped.items()}
+
+
+def _render(class_id, counts, detail, fmt):
+    name, size = Class.store_map_file(class_id, iter_class_map(counts, detail, fmt, _prepared[detail, fmt]), detail, fmt)
+    return class_id, detail, fmt, name, size
+
+
+def build_class_maps(class_ids, details=None, formats=("geojson",), processes=None):
+    """
+    :param class_ids: 班级id
+    :param details: 细节等级，默认只生成默认等级
+    :param formats: 地图格式
+    :param processes: 进程数，为 1 时在当前进程中生成
+    :return: {"classes": 班级数, "files": 文件数, "bytes": 总大小, "seconds": 耗时}
+    """
+    start = time.perf_counter()
+    class_ids = list(class_ids)
+    details = list(details or [destination_settings.MAP_DEFAULT_DETAIL])
+    generations = Class.get_map_generations(class_ids)
+    all_counts = get_classes_destination_counts(class_ids)
+    cache.set_many(
+        {Class.get_counts_cache_key(class_id): counts for class_id, counts in all_counts.items()},
+        destination_settings.MAP_COUNTS_TIMEOUT
+    )
+    for detail in details:
+        for fmt in formats:
+            _prepared[detail, fmt] = prepare_class_maps(detail, fmt)
+
+    tasks = [
+        (class_id, counts, detail, fmt)
+        for class_id, counts in all_counts.items()
+        for detail in details
+        for fmt in formats
+    ]
+    try:
+        if processes == 1 or len(tasks) <= 1:
+            results = [_render(*task) for task in tasks]
+        else:
+            # 子进程不能共用主进程的数据库连接
+            connections.close_all()
+            context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+                results = list(executor.map(_render, *zip(*tasks), chunksize=max(1, len(tasks) // 64)))
+    finally:
+        _prepared.clear()
+
+    total = 0
+    for class_id, detail, fmt, name, size in results:
+        Class.publish_map_file(class_id, name, detail, fmt, generations[class_id])
+        total += size
+    return {
+        "classes": len(class_ids),
+        "files": len(results),
+        "bytes": total,
+        "seconds": time.perf_counter() - start,
+    }
@@ -2,3 +2,4 @@
 from .user import Role, RoleStudent, RoleTeacher, User
 #
 from .class_ import Class, ClassMembership, ClassStudent, ClassTeacher
+from .rollup import DestinationRollup
@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
-import io
-import json
+import secrets
 
 from django.contrib.auth import get_user_model
 from django.db import models
-from django.db.models import QuerySet
-from django.core.files import File
 from django.core.cache import cache
 from imagekit.models import ImageSpecField, ProcessedImageField
 from pilkit.processors import ResizeToFill
 
-from account.models import RoleStudent
 from account.models.choices import ClassTypeChoice
-from destination.utils.geo import district_to_feature, district_to_point, get_district
+from destination.conf import settings as destination_settings
+from destination.utils import jobs
+from destination.utils.geo import aggregate_destination_counts
+from destination.utils.maps import MAP_FORMATS, build_class_map, get_district_overlay, get_map_overlay, iter_class_map
+from destination.utils.storage import delete_file, save_compressed, save_stream
 from utils import create_uuid, file_path_getter
 
 User = get_user_model()
@@ -144,86 +144,175 @@ class Class(models.Model):
     objects = ClassManager()
 
     # 去向统计部分
-    def get_map_geojson(self):
+    def get_destination_counts(self):
         """
+        一次 GROUP BY 查询统计班级学生的去向，省级人数由城市adcode在内存中汇总
+        结果会被缓存，学生去向和班级成员变化的事务提交后由 account.signals 清除
+        :return: {"cities": {adcode: count}, "schools": {school_id: count}, "provinces": {adcode: count}}
+        """
+        cache_key = self.get_counts_cache_key(self.pk)
+        counts = cache.get(cache_key)
+        if counts is None:
+            rows = (
+                self.students.values("city__adcode", "school_id")
+                .annotate(count=models.Count("pk"))
+                .order_by()
+            )
+            counts = aggregate_destination_counts(rows)
+            cache.set(cache_key, counts, destination_settings.MAP_COUNTS_TIMEOUT)
+        return counts
+
+    @classmethod
+    def invalidate_destination_counts(cls, class_ids):
+        cache.delete_many([cls.get_counts_cache_key(class_id) for class_id in class_ids])
+
+    @classmethod
+    def mark_maps_dirty(cls, class_ids):
+        """
+        标记班级的地图需要重新生成，下次访问时在后台刷新
+        先增加地图的版本号再清除标记，正在生成的地图不会被 publish_map_file 标记为最新
+        """
+        for class_id in class_ids:
+            key = cls.get_map_generation_key(class_id)
+            try:
+                cache.incr(key)
+            except ValueError:
+                # 从随机值开始，版本号被清除后不会回到以前的值
+                cache.set(key, secrets.randbelow(2 ** 31) + 1, None)
+        cache.delete_many([
+            cls.get_map_fresh_key(class_id, detail, fmt)
+            for class_id in class_ids
+            for detail in destination_settings.MAP_DETAILS
+            for fmt in MAP_FORMATS
+        ])
+
+    @classmethod
+    def get_map_generations(cls, class_ids):
+        """
+        生成地图时必须在读取去向统计之前调用，结果传给 publish_map_file
+        :return: {class_id: 地图的版本号}
+        """
+        keys = {cls.get_map_generation_key(class_id): class_id for class_id in class_ids}
+        found = cache.get_many(list(keys))
+        return {class_id: found.get(key, 0) for key, class_id in keys.items()}
 
+    @staticmethod
+    def get_counts_cache_key(class_id):
+        return f"CLASS_MAP_{class_id}_COUNTS"
+
+    def get_map_geojson(self, detail=None):
+        """
+
+        :param detail: 边界的细节等级，见 destination.conf 的 MAP_DETAILS
         :return: 携带整张地图信息的GeoJson数据，不携带具体学生信息
         *我在班级学生列表中携带了城市和学校信息，所以学生信息在前端通过过滤器形式匹配城市得到
         *前端性能问题...18M的地图还考虑性能问题？
         """
+        return build_class_map(self.get_destination_counts(), detail)
 
-        def get_students(city_name) -> QuerySet[RoleStudent]:
-            _students = self.students.filter(city__name=city_name)
-            return _students
-
-        # 四个直辖市和两个特别行政区
-        special_adcodes = [
-            "310000",  # 上海市
-            "500000",  # 重庆市
-            "810000",  # 香港特别行政区
-            "820000",  # 澳门特别行政区
-            "110000",  # 北京市
-        ]
-        # 地图采用geojson格式，点就不了
-        _map, points = ({"type": "FeatureCollection", "features": []},
-                        [])
-        # 获取中国边界信息
-        country = get_district(100000)
-        # feature_collection["features"].append(district_to_feature(country))
-        # print("country")
-        for district in country["districts"]:
-            # print("province", district["name"])
-            # 省级行政单位
-            if district["adcode"] in special_adcodes:
-                # 如果是特别行政区
-                students = get_students(district["name"])
-                if students.count() > 0:
-                    # 首先获得中心点Feature
-                    center_feature = district_to_point(district)
-                    center_feature["province"] = district["name"]
-                    center_feature["count"] = students.count()
-                    points.append(center_feature)
-                # 获得轮廓
-                all_district = get_district(district["adcode"], 0)
-                feature = district_to_feature(all_district)
-                feature["properties"]["count"] = students.count()
-                _map["features"].append(feature)
-            else:
-                # 如果是普通省
-                province = get_district(district["adcode"])
-                count = 0
-                for city in province["districts"]:
-                    students = get_students(city["name"])
-                    if len(students) > 0:
-                        count += len(students)
-                        feature = district_to_point(city)
-                        feature["count"] = students.count()
-                        feature["province"] = district["name"]
-                        points.append(feature)
-                province_feature = district_to_feature(province)
-                province_feature["properties"]["count"] = count
-                _map["features"].append(province_feature)
-
-        # echarts点必须单独拿出来，所以我这里修改一下分开搞
-        return {
-            "map": _map,
-            "points": points,
-        }
-
-    def create_map_file(self):
-        cache.get_or_set(self.map_cache_key, 43200)
-        file = io.StringIO()
-        file.name = "map.json"
-        file.seek(0)
-        json.dump(self.get_map_geojson(), file)
-        self.map = File(file)
-        self.save()
-        # 这样就实现了地图12小时刷新
-        cache.set(self.map_cache_key, "generated", 43200)
-
-    @property
-    def map_cache_key(self):
-        return f"CLASS_MAP_{self.created}_{self.name}_STATUS", "generating"
+    def get_map_overlay(self):
+        """
+        :return: 只有 {adcode: 人数} 和城市点，边界从底图获取
+        """
+        return get_map_overlay(self.get_destination_counts())
+
+    def get_district_overlay(self, adcode, children):
+        """
+        :param children: 行政区的直接下级，见 destination.utils.maps.get_district_children
+        :return: 下钻时行政区及其直接下级的人数
+        """
+        return get_district_overlay(self.get_destination_counts(), adcode, children)
+
+    def create_map_file(self, detail=None, fmt="geojson"):
+        """
+        文件名带有内容哈希，写入新文件后再切换缓存中的指向，正在读取旧文件的请求不受影响
+        :return: 新的地图文件名
+        """
+        detail = detail or destination_settings.MAP_DEFAULT_DETAIL
+        generation = self.get_map_generations([self.pk])[self.pk]
+        name, _ = self.store_map_file(self.pk, iter_class_map(self.get_destination_counts(), detail, fmt), detail, fmt)
+        self.publish_map_file(self.pk, name, detail, fmt, generation)
+        if detail == destination_settings.MAP_DEFAULT_DETAIL and fmt == "geojson":
+            self.map.name = name
+        return name
+
+    @classmethod
+    def store_map_file(cls, class_id, chunks, detail, fmt):
+        """
+        只写入文件，不访问数据库和缓存，可以在子进程中执行
+        :param chunks: iter_class_map 的结果，逐块写入临时文件后再移动到最终文件名
+        :return: (地图文件名, 文件大小)
+        """
+        name, _, size = save_stream(chunks, cls.get_map_name(class_id, detail, fmt, "{digest}"))
+        save_compressed(name)
+        return name, size
+
+    @classmethod
+    def publish_map_file(cls, class_id, name, detail, fmt, generation):
+        """
+        将缓存中的指向切换到新文件，并删除旧文件及其压缩版本
+        :param generation: 读取去向统计之前 get_map_generations 的结果，
+            生成期间版本号发生变化时新文件仍然会被使用，但不会被标记为最新
+        """
+        cache_key = cls.get_map_cache_key(class_id, detail, fmt)
+        old_name = cache.get(cache_key)
+        cache.set(cache_key, name, None)
+        # 地图在学生去向或班级成员变化前一直有效，见 mark_maps_dirty
+        fresh_key = cls.get_map_fresh_key(class_id, detail, fmt)
+        cache.set(fresh_key, True, None)
+        # 先设置再检查，mark_maps_dirty 在检查之后增加版本号时也会清除这里的标记
+        if cls.get_map_generations([class_id])[class_id] != generation:
+            cache.delete(fresh_key)
+        if detail == destination_settings.MAP_DEFAULT_DETAIL and fmt == "geojson":
+            Class.objects.filter(pk=class_id).update(map=name)
+        if old_name is not None and old_name != name:
+            delete_file(old_name)
+
+    def submit_map_job(self, detail, fmt="geojson"):
+        """
+        在后台生成地图，同一个班级、细节等级和格式同时只会有一个任务
+        :return: 是否提交了新的任务
+        """
+        return jobs.submit(self.get_map_cache_key(self.pk, detail, fmt), create_class_map_file, self.pk, detail, fmt)
+
+    def get_map_job_status(self, detail, fmt="geojson"):
+        return jobs.get_status(self.get_map_cache_key(self.pk, detail, fmt))
+
+    def get_map_file(self, detail, fmt="geojson"):
+        """
+        :return: 当前的地图文件名，尚未生成时返回 None
+        """
+        return cache.get(self.get_map_cache_key(self.pk, detail, fmt))
+
+    def is_map_fresh(self, detail, fmt="geojson"):
+        return bool(cache.get(self.get_map_fresh_key(self.pk, detail, fmt)))
+
+    @staticmethod
+    def get_map_name(class_id, detail, fmt, digest):
+        return f"map/{class_id}/{detail}.{digest}.{MAP_FORMATS[fmt]}"
+
+    @staticmethod
+    def get_map_digest(name):
+        """
+        :return: get_map_name 生成的文件名中的内容哈希
+        """
+        return name.rsplit(".", 2)[-2]
+
+    @staticmethod
+    def get_map_cache_key(class_id, detail, fmt="geojson"):
+        return f"CLASS_MAP_{class_id}_{detail}_{fmt}"
+
+    @staticmethod
+    def get_map_fresh_key(class_id, detail, fmt="geojson"):
+        return f"CLASS_MAP_{class_id}_{detail}_{fmt}_FRESH"
+
+    @staticmethod
+    def get_map_generation_key(class_id):
+        return f"CLASS_MAP_{class_id}_GENERATION"
+
+
+def create_class_map_file(class_id, detail, fmt):
+    Class.objects.get(pk=class_id).create_map_file(detail, fmt)
 
 
 class ClassMembership(models.Model):
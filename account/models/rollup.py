@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from django.db import IntegrityError, models, transaction
+
+from account.models.class_ import Class, ClassStudent
+from destination.utils.geo import province_adcode
+
+
+class DestinationRollup(models.Model):
+    """
+    按 (毕业年份, 班级类型, 省, 城市, 学校) 汇总的学生去向人数，用于整个年级或某个学校的统计
+    一个学生在几个班级中就计几次，与合并这些班级的地图结果一致
+    平时由 account.signals 增量更新，数据不一致时可以用 rebuild 重新统计
+    没有值的维度保存为 0 或空字符串，而不是 NULL，这样唯一约束才能生效
+    """
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["graduated", "class_type", "province", "city", "school"], name="destination_rollup"
+            )
+        ]
+        indexes = [
+            models.Index(fields=["school", "graduated"]),
+        ]
+
+    graduated = models.PositiveSmallIntegerField("毕业年份", default=0)
+    class_type = models.CharField("班级类型", max_length=15)
+    province = models.CharField("省级行政区adcode", max_length=6, blank=True)
+    city = models.CharField("城市adcode", max_length=6, blank=True)
+    school = models.CharField("学校id", max_length=10, blank=True)
+    count = models.IntegerField("人数", default=0)
+
+    GROUP_FIELDS = ["graduated", "class_type", "province", "city", "school"]
+
+    @staticmethod
+    def _key(graduated, class_type, adcode, school):
+        return {
+            "graduated": graduated or 0,
+            "class_type": class_type,
+            "province": province_adcode(adcode) if adcode else "",
+            "city": adcode or "",
+            "school": school or "",
+        }
+
+    @classmethod
+    def apply_delta(cls, class_ids, adcode, school, delta):
+        """
+        班级中一个去向为 (adcode, school) 的学生加入或离开
+        """
+        for graduated, class_type in Class.objects.filter(pk__in=class_ids).values_list("graduated", "type"):
+            key = cls._key(graduated, class_type, adcode, school)
+            with transaction.atomic():
+                if not cls.objects.filter(**key).update(count=models.F("count") + delta) and delta > 0:
+                    try:
+                        with transaction.atomic():
+                            cls.objects.create(**key, count=delta)
+                    except IntegrityError:
+                        # 其他请求同时创建了这一行
+                        cls.objects.filter(**key).update(count=models.F("count") + delta)
+                cls.objects.filter(**key, count__lte=0).delete()
+
+    @classmethod
+    def rebuild(cls, graduated=None, class_type=None):
+        """
+        用一次分组查询重新统计，可以只统计某一年毕业或某一类型的班级
+        :param graduated: 毕业年份，0 表示没有毕业年份的班级
+        """
+        members = ClassStudent.objects.all()
+        rollups = cls.objects.all()
+        if graduated is not None:
+            members = members.filter(classes__graduated=graduated or None)
+            rollups = rollups.filter(graduated=graduated)
+        if class_type is not None:
+            members = members.filter(classes__type=class_type)
+            rollups = rollups.filter(class_type=class_type)
+        rows = (
+            members.values("classes__graduated", "classes__type", "user_role__city__adcode", "user_role__school_id")
+            .annotate(count=models.Count("pk"))
+            .order_by()
+        )
+        with transaction.atomic():
+            rollups.delete()
+            cls.objects.bulk_create([
+                cls(
+                    **cls._key(row["classes__graduated"], row["classes__type"],
+                               row["user_role__city__adcode"], row["user_role__school_id"]),
+                    count=row["count"]
+                )
+                for row in rows
+            ])
+
+    @classmethod
+    def summarize(cls, by, **filters):
+        """
+        :param by: 分组的维度，GROUP_FIELDS 中的一个
+        :param filters: 各维度的筛选条件
+        :return: {"total": 总人数, "counts": {维度的值: 人数}}
+        """
+        rows = (
+            cls.objects.filter(**filters)
+            .values(by)
+            .annotate(total=models.Sum("count"))
+            .order_by(by)
+        )
+        counts = {row[by]: row["total"] for row in rows}
+        return {"total": sum(counts.values()), "counts": counts}
@@ -4,7 +4,7 @@ from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import PermissionsMixin
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models import Q, QuerySet
 from imagekit.models import ProcessedImageField
 from phonenumber_field.modelfields import PhoneNumberField
 from pilkit.processors import ResizeToFill
@@ -22,7 +22,72 @@ def user_avatar_path(instance, filename):
     return file_path_getter('avatar', instance, filename)
 
 
-class UserManager(BaseUserManager):
+def class_ids_of(user, class_type=None):
+    """
+    :param class_type: 只包括该类型的班级
+    :return: 用户所在班级（作为学生、任课老师或班主任）id 的子查询
+    不论用户在几个班级中 SQL 都相同
+    """
+    class_student = account_settings.models.class_student
+    class_teacher = account_settings.models.class_teacher
+    # 不使用 Class.objects，避免统计人数的 annotate
+    classes = QuerySet(model=account_settings.models.class_).filter(
+        Q(pk__in=class_student.objects.filter(user_role_id=user.pk).values("classes_id"))
+        | Q(pk__in=class_teacher.objects.filter(user_role_id=user.pk).values("classes_id"))
+        | Q(headteacher_id=user.pk)
+    )
+    if class_type is not None:
+        classes = classes.filter(type=class_type)
+    return classes.values("pk")
+
+
+def in_classes_of(user, field="classes", class_type=None):
+    """
+    :param field: 指向班级的字段
+    :return: field 是用户所在班级的条件
+    """
+    return Q(**{f"{field}__in": class_ids_of(user, class_type)})
+
+
+def members_filter(user, class_type=None):
+    """
+    与用户在同一班级中的用户（学生、任课老师和班主任），也是 account.permissions.OnSameClass 的规则
+    :return: User 的查询条件
+    """
+    class_ids = class_ids_of(user, class_type)
+    students = account_settings.models.class_student.objects.filter(classes_id__in=class_ids)
+    teachers = account_settings.models.class_teacher.objects.filter(classes_id__in=class_ids)
+    headteachers = QuerySet(model=account_settings.models.class_).filter(
+        pk__in=class_ids, headteacher__isnull=False
+    )
+    return (
+        Q(pk__in=students.values("user_role_id"))
+        | Q(pk__in=teachers.values("user_role_id"))
+        | Q(pk__in=headteachers.values("headteacher_id"))
+    )
+
+
+class UserQuerySet(QuerySet):
+    """
+    同学和老师的可见范围，不论用户在几个班级中，都只生成一条形状相同的 SQL
+    """
+
+    def classmates_of(self, user):
+        students = account_settings.models.class_student.objects.filter(in_classes_of(user))
+        return self.filter(pk__in=students.values("user_role_id"))
+
+    def teachers_of(self, user):
+        teachers = account_settings.models.class_teacher.objects.filter(in_classes_of(user))
+        return self.filter(pk__in=teachers.values("user_role_id"))
+
+    def visible_to(self, user, class_type=None):
+        """
+        :return: 用户可以看到的同学、任课老师和班主任
+        """
+        return self.filter(members_filter(user, class_type))
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     # 定义用户管理器方法
     def create_user(self, nickname=None, password=None, **extra_fields):
         """
@@ -133,22 +198,10 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.classes.filter(type=account_settings.choices.class_type.WALKING)
 
     def get_classmates(self) -> QuerySet:
-        # 该方案存在bug，只会获取一个用户
-        # return User.objects.filter(id__in=self.classes.values_list("students", flat=True).all())
-        # 下面这种写法等于 RoleStudent.objects.all() 要不是今天遇到bug还发现不了这个问题 这是一个安全问题！
-        # students = QuerySet(RoleStudent)
-        students = RoleStudent.objects.none()
-        for class_obj in self.classes.all():
-            students |= class_obj.students.all()
-        return User.objects.filter(pk__in=students.values_list("user", flat=True))
-
-    def get_teachers(self):
-        # -.-
-        # teachers = QuerySet(RoleTeacher)
-        teachers = RoleTeacher.objects.none()
-        for class_obj in self.classes.all():
-            teachers |= class_obj.teachers.all()
-        return User.objects.filter(pk__in=teachers.values_list("user", flat=True))
+        return User.objects.classmates_of(self)
+
+    def get_teachers(self) -> QuerySet:
+        return User.objects.teachers_of(self)
 
     @property
     def classes(self) -> QuerySet:
@@ -1,14 +1,126 @@
 # -*- coding: utf-8 -*-
+from functools import cached_property
+
 from django.contrib.auth import get_user_model
-from rest_framework.permissions import IsAuthenticated
+from django.db.models import Q, QuerySet
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.permissions import AND, NOT, OR, IsAuthenticated
 
 from account.conf import settings
 from account.models import Class, ClassMembership, ClassStudent, ClassTeacher
 from account.models.choices import AdminChoice
+from account.models.user import class_ids_of, members_filter
 
 User = get_user_model()
 
 
+class Membership:
+    """
+    当前用户与班级的关系，每个请求只读取一次，之后的对象权限检查不再查询数据库
+    """
+
+    def __init__(self, user):
+        self.user_pk = user.pk
+        self.class_ids, self.managed_ids, self.administrative_ids, self.edited_ids = set(), set(), set(), set()
+        if not user.is_authenticated:
+            return
+        # 不使用 Class.objects，避免统计人数的 annotate
+        rows = QuerySet(model=Class).filter(pk__in=class_ids_of(user)).values_list("pk", "headteacher_id", "type")
+        for pk, headteacher_id, class_type in rows:
+            self.class_ids.add(pk)
+            if headteacher_id == user.pk:
+                self.managed_ids.add(pk)
+            if class_type == settings.choices.class_type.ADMINISTRATIVE:
+                self.administrative_ids.add(pk)
+        self.edited_ids = set(Class.editors.through.objects.filter(user_id=user.pk).values_list("class_id", flat=True))
+
+    @cached_property
+    def members(self):
+        """
+        :return: {用户pk: 与当前用户共同所在的班级}，规则与 account.models.user.members_filter 相同，第一次使用时读取
+        """
+        ids = list(self.class_ids)
+        rows = ClassStudent.objects.filter(classes_id__in=ids).values_list("user_role_id", "classes_id").union(
+            ClassTeacher.objects.filter(classes_id__in=ids).values_list("user_role_id", "classes_id"),
+            QuerySet(model=Class).filter(pk__in=ids, headteacher__isnull=False)
+            .values_list("headteacher_id", "pk").order_by(),
+        )
+        members = {}
+        for user_pk, class_id in rows:
+            members.setdefault(user_pk, set()).add(class_id)
+        return members
+
+    def shares_class(self, user_pk, class_ids=None):
+        """
+        :param class_ids: 只考虑这些班级，默认为当前用户所在的所有班级
+        """
+        shared = self.members.get(user_pk, set())
+        return bool(shared if class_ids is None else shared & class_ids)
+
+
+def get_membership(request):
+    """
+    :return: 当前请求的 Membership，保存在 request 上
+    """
+    membership = getattr(request, "_membership", None)
+    if membership is None or membership.user_pk != request.user.pk:
+        membership = Membership(request.user)
+        request._membership = membership
+    return membership
+
+
+# 不匹配任何对象的条件
+NOTHING = Q(pk__in=[])
+
+
+def _classes_filter(model, class_ids):
+    """
+    :param class_ids: 班级 id 的子查询，SQL 不随班级数变化
+    :return: 班级或班级成员属于这些班级的条件，其他模型不限制
+    """
+    if issubclass(model, Class):
+        return Q(pk__in=class_ids)
+    if issubclass(model, ClassMembership):
+        return Q(classes_id__in=class_ids)
+    return None
+
+
+def get_permission_filter(permission, request, view, model):
+    """
+    把权限（包括用 |, & 组合的权限）转换为查询条件，与 has_permission 和 has_object_permission 对应
+    叶子权限通过 get_filter(request, view, model) 给出条件，没有该方法的权限不限制
+    :return: Q，None 表示不限制
+    """
+    if isinstance(permission, (OR, AND)):
+        op1 = get_permission_filter(permission.op1, request, view, model)
+        op2 = get_permission_filter(permission.op2, request, view, model)
+        if isinstance(permission, OR):
+            return None if op1 is None or op2 is None else op1 | op2
+        if op1 is None or op2 is None:
+            return op2 if op1 is None else op1
+        return op1 & op2
+    if isinstance(permission, NOT):
+        # 取反后无法保证比对象权限更严格，交给 has_object_permission
+        return None
+    if not permission.has_permission(request, view):
+        return NOTHING
+    get_filter = getattr(permission, "get_filter", None)
+    return get_filter(request, view, model) if get_filter is not None else None
+
+
+class PermissionFilter(BaseFilterBackend):
+    """
+    按视图的权限过滤查询集，列表和详情在同一条 SQL 中完成可见性的判断
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for permission in view.get_permissions():
+            q = get_permission_filter(permission, request, view, queryset.model)
+            if q is not None:
+                queryset = queryset.filter(q)
+        return queryset
+
+
 class _Admin(IsAuthenticated):
     def _has_permission(self, admin, request, view):
         return super().has_permission(request, view) and request.user.admin >= admin
@@ -34,6 +146,9 @@ class CurrentUser(IsAuthenticated):
         user = request.user
         return obj.pk == user.pk
 
+    def get_filter(self, request, view, model):
+        return Q(pk=request.user.pk) if issubclass(model, User) else None
+
 
 class Student(IsAuthenticated):
     def has_permission(self, request, view):
@@ -57,9 +172,12 @@ class CurrentMember(IsAuthenticated):
             return True
         return (
                 super(CurrentMember, self).has_permission(request, view)
-                and request.user.pk == obj.user_role.user.pk
+                and request.user.pk == obj.user_role_id
         )
 
+    def get_filter(self, request, view, model):
+        return Q(user_role_id=request.user.pk) if issubclass(model, ClassMembership) else None
+
 
 class OnSameAdministrativeClass(IsAuthenticated):
     def has_object_permission(self, request, view, obj):
@@ -67,19 +185,27 @@ class OnSameAdministrativeClass(IsAuthenticated):
             return True
         return (
                 super(OnSameAdministrativeClass, self).has_permission(request, view)
-                and (obj.get_administrative_class() & request.user.get_administrative_classes()).exists()
+                and get_membership(request).shares_class(obj.pk, get_membership(request).administrative_ids)
         )
 
+    def get_filter(self, request, view, model):
+        if not issubclass(model, User):
+            return None
+        return members_filter(request.user, settings.choices.class_type.ADMINISTRATIVE)
+
 
 class OnSameClass(IsAuthenticated):
     def has_object_permission(self, request, view, obj):
         if not isinstance(obj, User):
             return True
-        return (  # 有额外的数据库请求！
+        return (
                 super(OnSameClass, self).has_permission(request, view)
-                and (obj.classes & request.user.classes).exists()
+                and get_membership(request).shares_class(obj.pk)
         )
 
+    def get_filter(self, request, view, model):
+        return members_filter(request.user) if issubclass(model, User) else None
+
 
 class OnSameClassWithClassMemberShip(IsAuthenticated):
     def has_object_permission(self, request, view, obj):
@@ -87,9 +213,14 @@ class OnSameClassWithClassMemberShip(IsAuthenticated):
             return True
         return (
                 super(OnSameClassWithClassMemberShip, self).has_permission(request, view)
-                and request.user.classes.filter(pk=obj.classes.pk).exists()
+                and obj.classes_id in get_membership(request).class_ids
         )
 
+    def get_filter(self, request, view, model):
+        if not issubclass(model, ClassMembership):
+            return None
+        return Q(classes_id__in=class_ids_of(request.user))
+
 
 class CanEditCurrentClass(IsAuthenticated):
     def has_object_permission(self, request, view, obj):
@@ -97,10 +228,13 @@ class CanEditCurrentClass(IsAuthenticated):
             return True
         return (
                 super(CanEditCurrentClass, self).has_permission(request, view)
-                and isinstance(obj, Class)
-                and obj.editors.filter(pk=request.user.pk).exists()
+                and obj.pk in get_membership(request).edited_ids
         )
 
+    def get_filter(self, request, view, model):
+        edited = Class.editors.through.objects.filter(user_id=request.user.pk).values("class_id")
+        return _classes_filter(model, edited)
+
 
 class OnCurrentClass(IsAuthenticated):
     def has_object_permission(self, request, view, obj):
@@ -108,14 +242,12 @@ class OnCurrentClass(IsAuthenticated):
             return True
         return (
                 super(OnCurrentClass, self).has_permission(request, view)
-                and request.user.role_obj is not None
-                and (
-                        obj.students.filter(pk=request.user.role_obj.pk).exists()
-                        or obj.headteacher.pk == request.user.role_obj.pk
-                        or obj.teachers.filter(pk=request.user.role_obj.pk).exists()
-                )
+                and obj.pk in get_membership(request).class_ids
         )
 
+    def get_filter(self, request, view, model):
+        return _classes_filter(model, class_ids_of(request.user))
+
 
 class IsMapActive(OnCurrentClass):
     def has_object_permission(self, request, view, obj):
@@ -133,10 +265,12 @@ class ManageCurrentClass(IsAuthenticated):
             return True
         return (
                 super(ManageCurrentClass, self).has_permission(request, view)
-                and request.user.role == settings.choices.user_role.TEACHER
-                and request.user.role_teacher.managed_classes.filter(pk=obj.pk).exists()
+                and obj.pk in get_membership(request).managed_ids
         )
 
+    def get_filter(self, request, view, model):
+        return _classes_filter(model, QuerySet(model=Class).filter(headteacher_id=request.user.pk).values("pk"))
+
 
 CurrentUserOrAdmin = CurrentUser | Admin
 
@@ -20,27 +20,32 @@ class ClassPublicSimpleSerializer(serializers.ModelSerializer):
 
 
 def _get_members(role, serializer, through_serializer, **kwargs):
+    """
+    从中间表一次取出班级成员及其用户、学校、城市和职位，查询数与人数无关
+    """
     def func(self, obj):
-        # TODO: 暂时采用该方案，中间件在序列化的时候获取
-        # return serializer(getattr(obj, role).prefetch_related("user").values_list("user", flat=True), many=True).data
-        members = getattr(obj, role)
-        # return serializer([member.user for member in members.all()], many=True, **kwargs).data
-        '''
-        在此处我会实现中间件的获取，必要的话会在这里添加班干部和课代表信息吗。
-        我会在序列化完成之后添加，获取中间件本来就有数据库请求，所以（理论上）这个方案不会带来额外的请求。
-        中间件本来就需要自己获取！
-        '''
+        if role == 'students':
+            throughs = (
+                ClassStudent.objects.filter(classes=obj)
+                .select_related("user_role__user", "user_role__school", "user_role__city")
+                .prefetch_related("position")
+                .order_by("user_role_id")
+            )
+        elif role == 'teachers':
+            throughs = (
+                ClassTeacher.objects.filter(classes=obj)
+                .select_related("user_role__user")
+                .order_by("user_role_id")
+            )
+        else:
+            raise ValueError()
+        throughs = list(throughs)
+        # 修复bug，图片路径不是url：附带context
+        users = serializer(
+            [through.user_role.user for through in throughs], many=True, **kwargs, context=self.context
+        ).data
         ret = []
-        for member in members.all():
-            # 修复bug，图片路径不是url：附带context
-            data = serializer(member.user, **kwargs, context=self.context).data
-            if role == 'students':
-                through = ClassStudent.objects.get(user_role=member, classes=self.instance)
-            elif role == 'teachers':
-                through = ClassTeacher.objects.get(user_role=member, classes=self.instance)
-            else:
-                raise ValueError()
-            through_data = through_serializer(through, context=self.context).data
+        for data, through_data in zip(users, through_serializer(throughs, many=True, context=self.context).data):
             data.update(through_data)
             ret.append(data)
         return ret
@@ -9,7 +9,7 @@ from rest_framework import serializers
 
 from account.conf import settings
 from account.models import RoleStudent, RoleTeacher
-from destination.models import City, School
+from destination.utils.reference import get_reference
 
 User = get_user_model()
 
@@ -164,18 +164,18 @@ class UserStudentSetSerializer(serializers.ModelSerializer):
     def validate_school(self, value):
         if value is None:
             return None
-        school = School.objects.filter(name=value)
-        if not school.exists():
+        school = get_reference().school_by_name.get(value)
+        if school is None:
             raise serializers.ValidationError(f"学校{value}不存在")
-        return school.first()
+        return school
 
     def validate_city(self, value):
         if value is None:
             return None
-        city = City.objects.filter(name=value)
-        if not city.exists():
+        city = get_reference().city_by_name.get(value)
+        if city is None:
             raise serializers.ValidationError(f"城市{value}不存在")
-        return city.first()
+        return city
 
     def update(self, instance, validated_data):
         # 不能有多对多关系
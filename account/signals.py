@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+跟踪学生去向和班级成员的变化，只清除受影响班级的去向统计并标记它们的地图需要刷新，
+缓存在事务提交后才清除，回滚的修改不会留在缓存中
+"""
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from account.models import Class, ClassStudent, DestinationRollup, RoleStudent
+
+
+def _destination(role_student_id):
+    """
+    :return: (城市adcode, 学校id)，学生不存在时返回 None
+    """
+    return (
+        RoleStudent.objects.filter(pk=role_student_id)
+        .values_list("city__adcode", "school_id")
+        .first()
+    )
+
+
+def _invalidate_classes(class_ids):
+    """
+    事务提交后清除班级的去向统计并标记地图需要刷新，下次读取时按已提交的数据重新统计
+    """
+
+    def invalidate():
+        Class.invalidate_destination_counts(class_ids)
+        Class.mark_maps_dirty(class_ids)
+
+    transaction.on_commit(invalidate)
+
+
+def _update_classes(class_ids, adcode, school, delta):
+    class_ids = list(class_ids)
+    if class_ids:
+        _invalidate_classes(class_ids)
+        DestinationRollup.apply_delta(class_ids, adcode, school, delta)
+
+
+@receiver(pre_save, sender=RoleStudent)
+def remember_destination(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {"city", "school"} & set(update_fields):
+        instance._previous_destination = None
+        return
+    instance._previous_destination = _destination(instance.pk)
+
+
+@receiver(post_save, sender=RoleStudent)
+def track_destination(sender, instance, created, **kwargs):
+    previous = getattr(instance, "_previous_destination", None)
+    if created or previous is None:
+        return
+    current = (instance.city.adcode if instance.city_id is not None else None, instance.school_id)
+    if current == tuple(previous):
+        return
+    class_ids = list(ClassStudent.objects.filter(user_role=instance).values_list("classes_id", flat=True))
+    _update_classes(class_ids, *previous, -1)
+    _update_classes(class_ids, *current, 1)
+
+
+@receiver(m2m_changed, sender=Class.students.through)
+def track_members_added(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    add() 使用 bulk_create，不会触发 ClassStudent 的 post_save；删除则统一由 post_delete 处理
+    """
+    if action != "post_add" or not pk_set:
+        return
+    if reverse:
+        # 从学生一侧添加班级
+        adcode, school = _destination(instance.pk)
+        _update_classes(pk_set, adcode, school, 1)
+    else:
+        for adcode, school in RoleStudent.objects.filter(pk__in=pk_set).values_list("city__adcode", "school_id"):
+            _update_classes([instance.pk], adcode, school, 1)
+
+
+@receiver(post_save, sender=ClassStudent)
+def track_member_created(sender, instance, created, **kwargs):
+    if created:
+        destination = _destination(instance.user_role_id)
+        if destination is not None:
+            _update_classes([instance.classes_id], *destination, 1)
+
+
+@receiver(post_delete, sender=ClassStudent)
+def track_member_removed(sender, instance, **kwargs):
+    destination = _destination(instance.user_role_id)
+    if destination is None:
+        # 学生本身被删除，无法得知其去向，分组统计需要重新计算
+        _invalidate_classes([instance.classes_id])
+        class_obj = Class.objects.filter(pk=instance.classes_id).values_list("graduated", "type").first()
+        if class_obj is not None:
+            DestinationRollup.rebuild(class_obj[0] or 0, class_obj[1])
+    else:
+        _update_classes([instance.classes_id], *destination, -1)
+
+
+@receiver(pre_save, sender=Class)
+def remember_grade(sender, instance, **kwargs):
+    instance._previous_grade = Class.objects.filter(pk=instance.pk).values_list("graduated", "type").first()
+
+
+@receiver(post_save, sender=Class)
+def track_grade(sender, instance, created, **kwargs):
+    """
+    班级的毕业年份或类型变化后，重新统计前后两个分组
+    """
+    previous = getattr(instance, "_previous_grade", None)
+    current = (instance.graduated, instance.type)
+    if created or previous is None or tuple(previous) == current:
+        return
+    for graduated, class_type in [previous, current]:
+        DestinationRollup.rebuild(graduated or 0, class_type)
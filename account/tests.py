@@ -1,3 +1,330 @@
+from types import SimpleNamespace
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from account.models import Class, ClassStudent, DestinationRollup, RoleStudent, RoleTeacher, User
+from account.models.choices import AdminChoice, ClassTypeChoice, UserRoleChoice
+from account.permissions import CanEditCurrentClass, ManageCurrentClass, OnCurrentClass, OnSameAdministrativeClass, \
+    OnSameClass, get_membership
+from destination.models import City, School
+
+
+class ClassDataMixin:
+    """
+    两个班级：
+        c1（行政班）：学生 s0 s1 s2，任课老师 t，班主任 t，s3 可以编辑
+        c2（走班）：学生 s2 s3，班主任 h
+    """
+
+    @classmethod
+    def create_student(cls, pk, city=None, school=None):
+        user = User.objects.create(id=pk, nickname=f"n{pk}", name=f"S{pk[-1]}", role=UserRoleChoice.STUDENT)
+        return RoleStudent.objects.create(user=user, city=city, school=school)
+
+    @classmethod
+    def create_teacher(cls, pk):
+        user = User.objects.create(id=pk, nickname=f"n{pk}", name=f"T{pk[-1]}", role=UserRoleChoice.TEACHER)
+        return RoleTeacher.objects.create(user=user, subject="数学")
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.beijing = City.objects.create(name="北京市", adcode="110000")
+        cls.shijiazhuang = City.objects.create(name="石家庄市", adcode="130100")
+        cls.pku = School.objects.create(id="4111010001", name="北京大学", city=cls.beijing)
+        cls.t = cls.create_teacher("90000000")
+        cls.h = cls.create_teacher("90000001")
+        cls.s = [
+            cls.create_student("10000000", cls.beijing, cls.pku),
+            cls.create_student("10000001", cls.shijiazhuang),
+            cls.create_student("10000002", cls.beijing, cls.pku),
+            cls.create_student("10000003"),
+        ]
+        cls.c1 = Class.objects.create(
+            id="C0000001", name="K2111", created=2021, graduated=2024,
+            type=ClassTypeChoice.ADMINISTRATIVE, headteacher=cls.t
+        )
+        cls.c2 = Class.objects.create(
+            id="C0000002", name="K2112", created=2021, graduated=2024,
+            type=ClassTypeChoice.WALKING, headteacher=cls.h
+        )
+        cls.c1.teachers.add(cls.t)
+        cls.c1.students.add(*cls.s[:3])
+        cls.c2.students.add(*cls.s[2:])
+        cls.c1.editors.add(cls.s[3].user)
+        cls.admin = User.objects.create(id="70000000", nickname="admin", name="A", admin=AdminChoice.NORMAL)
+        cls.outsider = cls.create_student("10000009")
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def login(self, user):
+        self.client.force_authenticate(user.user if hasattr(user, "user") else user)
+
+
+def ids(response):
+    data = response.data["results"] if "results" in response.data else response.data
+    return sorted(item["id"] for item in data)
+
+
+class MembershipTests(ClassDataMixin, TestCase):
+    def request(self, role):
+        return SimpleNamespace(user=role.user if hasattr(role, "user") else role)
+
+    def test_snapshot(self):
+        membership = get_membership(self.request(self.s[3]))
+        self.assertEqual(membership.class_ids, {"C0000002"})
+        self.assertEqual(membership.edited_ids, {"C0000001"})
+        self.assertEqual(membership.managed_ids, set())
+        self.assertEqual(membership.administrative_ids, set())
+        membership = get_membership(self.request(self.t))
+        self.assertEqual(membership.class_ids, {"C0000001"})
+        self.assertEqual(membership.managed_ids, {"C0000001"})
+        self.assertEqual(membership.administrative_ids, {"C0000001"})
+        self.assertEqual(get_membership(self.request(AnonymousUser())).class_ids, set())
+
+    def test_one_snapshot_per_request(self):
+        request = self.request(self.s[2])
+        with self.assertNumQueries(3):
+            membership = get_membership(request)
+            # 第一次使用 members 时读取一次
+            self.assertTrue(membership.shares_class(self.s[0].pk))
+        with self.assertNumQueries(0):
+            self.assertIs(get_membership(request), membership)
+            self.assertTrue(membership.shares_class(self.s[3].pk))
+            self.assertTrue(membership.shares_class(self.h.pk))
+            self.assertFalse(membership.shares_class(self.outsider.pk))
+            for permission, obj in [(OnSameClass(), self.t.user), (OnCurrentClass(), self.c1),
+                                    (CanEditCurrentClass(), self.c1), (ManageCurrentClass(), self.c2)]:
+                permission.has_object_permission(request, None, obj)
+
+    def test_recreated_when_user_changes(self):
+        request = self.request(self.s[0])
+        membership = get_membership(request)
+        request.user = self.s[3].user
+        self.assertIsNot(get_membership(request), membership)
+        self.assertEqual(get_membership(request).class_ids, {"C0000002"})
+
+    def test_shares_administrative_class(self):
+        # s2 与 s0 在行政班 c1，与 s3 只在走班 c2
+        membership = get_membership(self.request(self.s[2]))
+        self.assertTrue(membership.shares_class(self.s[0].pk, membership.administrative_ids))
+        self.assertTrue(membership.shares_class(self.s[3].pk))
+        self.assertFalse(membership.shares_class(self.s[3].pk, membership.administrative_ids))
+        request = self.request(self.s[2])
+        self.assertTrue(OnSameAdministrativeClass().has_object_permission(request, None, self.s[0].user))
+        self.assertFalse(OnSameAdministrativeClass().has_object_permission(request, None, self.s[3].user))
+
+    def test_edited_and_managed(self):
+        cases = [
+            (self.s[3], self.c1, True, False),
+            (self.s[3], self.c2, False, False),
+            (self.t, self.c1, False, True),
+            (self.h, self.c2, False, True),
+            (self.s[0], self.c1, False, False),
+        ]
+        for role, class_obj, can_edit, manages in cases:
+            request = self.request(role)
+            self.assertEqual(CanEditCurrentClass().has_object_permission(request, None, class_obj), can_edit)
+            self.assertEqual(ManageCurrentClass().has_object_permission(request, None, class_obj), manages)
+
+
+class PermissionFilterTests(ClassDataMixin, TestCase):
+    def test_class_list(self):
+        self.login(self.s[0])
+        self.assertEqual(ids(self.client.get("/classes/")), ["C0000001"])
+        # 可以编辑的班级也能看到
+        self.login(self.s[3])
+        self.assertEqual(ids(self.client.get("/classes/")), ["C0000001", "C0000002"])
+        self.login(self.h)
+        self.assertEqual(ids(self.client.get("/classes/")), ["C0000002"])
+        self.login(self.admin)
+        self.assertEqual(ids(self.client.get("/classes/")), ["C0000001", "C0000002"])
+        self.login(self.outsider)
+        self.assertEqual(ids(self.client.get("/classes/")), [])
+
+    def test_class_retrieve_outside_is_404(self):
+        self.login(self.s[0])
+        self.assertEqual(self.client.get("/classes/C0000001/").status_code, 200)
+        self.assertEqual(self.client.get("/classes/C0000002/").status_code, 404)
+
+    def test_can_edit(self):
+        self.login(self.s[3])
+        self.assertTrue(self.client.get("/classes/C0000001/").data["can_edit"])
+        self.assertFalse(self.client.get("/classes/C0000002/").data["can_edit"])
+        self.login(self.t)
+        self.assertTrue(self.client.get("/classes/C0000001/").data["can_edit"])
+
+    def test_user_list_includes_classmates_teachers_and_headteachers(self):
+        self.login(self.s[0])
+        self.assertEqual(ids(self.client.get("/users/")), ["10000000", "10000001", "10000002", "90000000"])
+        self.login(self.s[3])
+        self.assertEqual(ids(self.client.get("/users/")), ["10000002", "10000003", "90000001"])
+        self.login(self.outsider)
+        self.assertEqual(ids(self.client.get("/users/")), [])
+        self.login(self.admin)
+        self.assertEqual(len(ids(self.client.get("/users/"))), User.objects.count())
+
+    def test_user_list_matches_visible_to(self):
+        for role in self.s + [self.t, self.h, self.outsider]:
+            self.login(role)
+            self.assertEqual(
+                ids(self.client.get("/users/")),
+                sorted(User.objects.visible_to(role.user).values_list("pk", flat=True))
+            )
+
+    def test_user_retrieve_outside_is_404(self):
+        self.login(self.s[0])
+        self.assertEqual(self.client.get("/users/10000001/").status_code, 200)
+        self.assertEqual(self.client.get("/users/10000003/").status_code, 404)
+
+    def test_nested_members_limited_to_own_classes(self):
+        self.login(self.s[0])
+        self.assertEqual(len(self.client.get("/classes/C0000001/students/").data), 3)
+        self.assertEqual(len(self.client.get("/classes/C0000002/students/").data), 0)
+        self.assertEqual(self.client.get("/classes/C0000002/students/10000003/").status_code, 404)
+        self.assertEqual(len(self.client.get("/classes/C0000001/teachers/").data), 1)
+        self.assertEqual(len(self.client.get("/classes/C0000002/teachers/").data), 0)
+        # 可以编辑的班级
+        self.login(self.s[3])
+        self.assertEqual(len(self.client.get("/classes/C0000001/students/").data), 3)
+
+    def test_current_member_update(self):
+        self.login(self.s[1])
+        url = "/classes/C0000001/students/{}/?partial=true"
+        self.assertEqual(self.client.put(url.format("10000001"), {"aka": "x"}).status_code, 200)
+        # 别人的成员信息不在可修改的范围内
+        self.assertEqual(self.client.put(url.format("10000000"), {"aka": "x"}).status_code, 404)
+        self.assertEqual(ClassStudent.objects.get(classes=self.c1, user_role=self.s[1]).aka, "x")
+
+    def test_user_list_sql_does_not_depend_on_class_count(self):
+        def list_sql(user):
+            """
+            :return: 分页统计总数的查询，包含完整的权限过滤条件
+            """
+            self.login(user)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get("/users/")
+            return queries[0]["sql"].replace(user.pk, "?")
+
+        one = list_sql(self.s[0].user)
+        for i in range(3):
+            Class.objects.create(id=f"C100000{i}", name="K2200", created=2022, type=ClassTypeChoice.WALKING,
+                                 headteacher=self.h).students.add(self.s[0])
+        self.assertEqual(one, list_sql(self.s[0].user))
+
+
+class DestinationCountsTests(ClassDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_counts(self):
+        counts = self.c1.get_destination_counts()
+        self.assertEqual(counts["cities"], {"110000": 2, "130100": 1})
+        self.assertEqual(counts["schools"], {"4111010001": 2})
+        self.assertEqual(counts["provinces"], {"110000": 2, "130000": 1})
+
+    def test_change_clears_counts_after_commit(self):
+        self.c1.get_destination_counts()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.s[1].city = self.beijing
+            self.s[1].save()
+            # 提交前缓存不变
+            self.assertEqual(self.c1.get_destination_counts()["cities"], {"110000": 2, "130100": 1})
+        self.assertEqual(self.c1.get_destination_counts()["cities"], {"110000": 3})
+
+    def test_rollback_keeps_counts(self):
+        counts = self.c1.get_destination_counts()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.s[1].city = self.beijing
+                self.s[1].save()
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.c1.get_destination_counts(), counts)
+
+    def test_member_changes_clear_counts(self):
+        self.c2.get_destination_counts()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.c2.students.add(self.s[0])
+        self.assertEqual(self.c2.get_destination_counts()["cities"], {"110000": 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            ClassStudent.objects.filter(classes=self.c2, user_role=self.s[2]).delete()
+        self.assertEqual(self.c2.get_destination_counts()["cities"], {"110000": 1})
+
+
+class MapFreshnessTests(ClassDataMixin, TestCase):
+    detail = "low"
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_publish_marks_fresh_until_dirty(self):
+        generation = Class.get_map_generations([self.c1.pk])[self.c1.pk]
+        Class.publish_map_file(self.c1.pk, "map/C0000001/a.json", self.detail, "geojson", generation)
+        self.assertTrue(self.c1.is_map_fresh(self.detail))
+        self.assertEqual(self.c1.get_map_file(self.detail), "map/C0000001/a.json")
+        Class.mark_maps_dirty([self.c1.pk])
+        self.assertFalse(self.c1.is_map_fresh(self.detail))
+
+    def test_dirty_during_build_is_not_fresh(self):
+        generation = Class.get_map_generations([self.c1.pk])[self.c1.pk]
+        # 生成期间学生去向发生变化
+        Class.mark_maps_dirty([self.c1.pk])
+        Class.publish_map_file(self.c1.pk, "map/C0000001/a.json", self.detail, "geojson", generation)
+        self.assertFalse(self.c1.is_map_fresh(self.detail))
+        # 新文件仍然会被使用
+        self.assertEqual(self.c1.get_map_file(self.detail), "map/C0000001/a.json")
+        Class.mark_maps_dirty([self.c1.pk])
+        self.assertNotEqual(Class.get_map_generations([self.c1.pk])[self.c1.pk], generation)
+
+
+class DestinationRollupTests(ClassDataMixin, TestCase):
+    def snapshot(self):
+        return sorted(DestinationRollup.objects.values_list(*DestinationRollup.GROUP_FIELDS, "count"))
+
+    def assertMatchesRebuild(self):
+        incremental = self.snapshot()
+        DestinationRollup.rebuild()
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_incremental_matches_rebuild(self):
+        self.assertMatchesRebuild()
+        self.assertEqual(
+            DestinationRollup.summarize("city", graduated=2024)["counts"],
+            {"": 1, "110000": 3, "130100": 1}
+        )
+
+    def test_destination_change(self):
+        self.s[2].city, self.s[2].school = self.shijiazhuang, None
+        self.s[2].save()
+        self.assertMatchesRebuild()
+        self.assertEqual(DestinationRollup.summarize("school")["counts"], {"": 4, "4111010001": 1})
+
+    def test_member_changes(self):
+        self.c2.students.add(self.s[0])
+        self.assertMatchesRebuild()
+        ClassStudent.objects.filter(classes=self.c1, user_role=self.s[1]).delete()
+        self.assertMatchesRebuild()
+        self.s[0].user.delete()
+        self.assertMatchesRebuild()
+
+    def test_grade_change(self):
+        self.c2.graduated = 2025
+        self.c2.save()
+        self.assertMatchesRebuild()
+        self.assertEqual(DestinationRollup.summarize("graduated")["counts"], {2024: 3, 2025: 2})
 
-# Create your tests here.
+    def test_statistics(self):
+        self.login(self.admin)
+        response = self.client.get("/classes/statistics/", {"by": "province", "type": ClassTypeChoice.ADMINISTRATIVE})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["counts"], {"110000": 2, "130000": 1})
+        self.login(self.s[0])
+        self.assertEqual(self.client.get("/classes/statistics/").status_code, 403)
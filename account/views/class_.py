@@ -1,20 +1,29 @@
 # -*- coding: utf-8 -*-
-import warnings
 
 from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework_nested.viewsets import NestedViewSetMixin
-from django.conf import settings as django_settings
-from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
 
 from account.conf import settings
+from account.maps import build_class_maps
+from account.models import DestinationRollup
 from account.models.class_ import Class, ClassStudent, ClassTeacher
 from account.models.choices import UserRoleChoice
-from account.permissions import AdminSuper, CurrentMemberOrAdmin, IsMapActive, ManageCurrentClassOrAdmin, \
-    OnCurrentClassOrAdmin, OnSameClassWithClassMembershipOrAdmin
+from account.permissions import Admin, AdminSuper, CurrentMemberOrAdmin, IsMapActive, ManageCurrentClassOrAdmin, \
+    OnCurrentClassOrAdmin, OnSameClassWithClassMembershipOrAdmin, PermissionFilter
 from account.serializers.class_ import ClassPublicSimpleSerializer
+from destination.conf import settings as destination_settings
+from destination.renderers import MAP_RENDERER_CLASSES, get_map_format
+from destination.utils import jobs
+from destination.utils.maps import MAP_FORMATS, get_district_children
+from destination.views import get_base_map_manifest, get_district_map_manifest, get_map_content_type, \
+    get_map_detail, serve_file
+
+BUILD_MAPS_JOB_KEY = "BUILD_CLASS_MAPS"
 
 
 class ClassViewSet(
@@ -26,27 +35,22 @@ class ClassViewSet(
     viewsets.GenericViewSet
 ):
     serializer_class = ClassPublicSimpleSerializer
-    queryset = Class.objects.all()
+    queryset = Class.objects.select_related("headteacher__user")
     permission_classes = [OnCurrentClassOrAdmin]
+    # 不是管理员时只能获取自己所在或可以编辑的班级
+    filter_backends = [PermissionFilter]
     lookup_field = 'id'
 
-    def get_queryset(self):
-        user = self.request.user
-        queryset = super().get_queryset()
-        if user.admin == 0:
-            # 如果不是管理员，则只能获取自己所在的班级
-            warnings.warn("暂时禁止列出自己不在的班级", Warning)
-            queryset = user.classes.all() | user.edited_classes.all()
-        return queryset
-
     def get_permissions(self):
         # if self.action == 'list':
         #     self.permission_classes = settings.
         if self.action in ["photo", "partial_update", "update"]:
             self.permission_classes = [ManageCurrentClassOrAdmin]
-        elif self.action in ["create", "members"]:
+        elif self.action in ["create", "members", "build_maps"]:
             self.permission_classes = [AdminSuper]
-        elif self.action == "map":
+        elif self.action == "statistics":
+            self.permission_classes = [Admin]
+        elif self.action in ["map", "map_status", "map_file", "map_overlay", "map_district"]:
             self.permission_classes = [IsMapActive]
         return super().get_permissions()
 
@@ -127,20 +131,136 @@ class ClassViewSet(
         obj.save()
         return Response(data={"teacher_count": obj.teachers.count(), "student_count": obj.students.count()})
 
-    @action(detail=True, methods=["get"])
+    def _get_map_params(self, request):
+        detail = get_map_detail(request)
+        if detail is None:
+            raise ValidationError({"errors": ["detail 不在可选范围内"]})
+        return detail, get_map_format(request)
+
+    def _map_status_data(self, request, class_obj, detail, fmt):
+        name = class_obj.get_map_file(detail, fmt)
+        if name is not None:
+            url = reverse("class-map-file", kwargs={
+                "id": class_obj.id, "detail": detail, "digest": Class.get_map_digest(name)
+            })
+        return {
+            "map": request.build_absolute_uri(url) if name is not None else None,
+            "detail": detail,
+            "format": fmt,
+            "state": class_obj.get_map_job_status(detail, fmt),
+            "status": request.build_absolute_uri(
+                reverse("class-map-status", kwargs={"id": class_obj.id}) + f"?detail={detail}&format={fmt}"
+            ),
+        }
+
+    @action(detail=True, methods=["get"], renderer_classes=MAP_RENDERER_CLASSES)
     def map(self, request, *args, **kwargs):
+        """
+        地图在后台生成，请求不会等待生成过程：
+        有地图文件时直接返回（过期的同时在后台刷新），没有时返回 202 和查询状态的地址
+        同一个班级的地图同时只会有一个生成任务，生成完成后才切换到新文件
+        """
         class_obj = self.get_object()
-        """这里考虑到一个问题：如果另一个用户访问时正在创建文件，缓存状态为generating，此时我再次创建
-        可能导致：1. 文件被占用报错 2. 资源使用过多 3. 缓存状态卡在generating"""
-        if not class_obj.map or not cache.get(class_obj.map_cache_key) == 'generated':
-            class_obj.create_map_file()
-        else:
-            fp = django_settings.MEDIA_ROOT / class_obj.map.name
-            if not fp.exists():
-                class_obj.create_map_file()
-        return Response(data={
-            "map": request.build_absolute_uri(class_obj.map.url),
-        })
+        detail, fmt = self._get_map_params(request)
+        name = class_obj.get_map_file(detail, fmt)
+        if name is None or not class_obj.is_map_fresh(detail, fmt) or not default_storage.exists(name):
+            class_obj.submit_map_job(detail, fmt)
+        data = self._map_status_data(request, class_obj, detail, fmt)
+        if data["map"] is None:
+            return Response(data=data, status=status.HTTP_202_ACCEPTED, content_type="application/json")
+        return Response(data=data, content_type="application/json")
+
+    @action(detail=True, methods=["get"], url_path="map/status", renderer_classes=MAP_RENDERER_CLASSES)
+    def map_status(self, request, *args, **kwargs):
+        class_obj = self.get_object()
+        detail, fmt = self._get_map_params(request)
+        return Response(data=self._map_status_data(request, class_obj, detail, fmt), content_type="application/json")
+
+    @action(detail=True, methods=["get"], url_path=r"map/files/(?P<detail>\w+)/(?P<digest>[0-9a-f]+)", url_name="map-file")
+    def map_file(self, request, detail, digest, *args, **kwargs):
+        """
+        地图文件，优先发送预压缩的版本；文件名带有内容哈希，地图刷新后地址会改变
+        """
+        class_obj = self.get_object()
+        for fmt in MAP_FORMATS:
+            name = class_obj.get_map_file(detail, fmt)
+            if name is not None and Class.get_map_digest(name) == digest and default_storage.exists(name):
+                return serve_file(request, name, get_map_content_type(fmt), digest, "private, max-age=31536000, immutable")
+        raise NotFound()
+
+    @action(detail=False, methods=["get", "post"], url_path="maps/build")
+    def build_maps(self, request, *args, **kwargs):
+        """
+        POST 在后台批量生成地图，可以指定 classes、details、formats，默认为所有开启地图的班级；GET 查看任务状态
+        """
+        if request.method.upper() == "POST":
+            class_ids = request.data.get("classes")
+            if not class_ids:
+                class_ids = list(Class.objects.filter(map_activated=True).values_list("pk", flat=True))
+            details = request.data.get("details") or [destination_settings.MAP_DEFAULT_DETAIL]
+            formats = request.data.get("formats") or ["geojson"]
+            if not set(details) <= set(destination_settings.MAP_DETAILS) or not set(formats) <= set(MAP_FORMATS):
+                raise ValidationError({"errors": ["details 或 formats 不在可选范围内"]})
+            submitted = jobs.submit(BUILD_MAPS_JOB_KEY, build_class_maps, class_ids, details, formats, 1)
+            return Response(status=status.HTTP_202_ACCEPTED, data={
+                "submitted": submitted,
+                "state": jobs.get_status(BUILD_MAPS_JOB_KEY),
+            })
+        return Response(data={"state": jobs.get_status(BUILD_MAPS_JOB_KEY)})
+
+    @action(detail=False, methods=["get"])
+    def statistics(self, request, *args, **kwargs):
+        """
+        年级或学校的去向统计，由汇总表一次查询得到
+        筛选：graduated, type, province, city, school；分组：by，默认为 province
+        """
+        by = request.query_params.get("by", "province")
+        if by not in DestinationRollup.GROUP_FIELDS:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["by 不在可选范围内"]})
+        filters = {
+            field: request.query_params[param]
+            for field, param in [("class_type", "type"), ("province", "province"), ("city", "city"),
+                                 ("school", "school")]
+            if param in request.query_params
+        }
+        if "graduated" in request.query_params:
+            try:
+                filters["graduated"] = int(request.query_params["graduated"])
+            except ValueError:
+                return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["graduated 必须是年份"]})
+        return Response(data={"by": by, **DestinationRollup.summarize(by, **filters)})
+
+    @action(detail=True, methods=["get"], url_path="map/overlay", renderer_classes=MAP_RENDERER_CLASSES)
+    def map_overlay(self, request, *args, **kwargs):
+        """
+        班级地图的叠加层，边界从底图获取，刷新时只需要传输几KB
+        底图尚未生成时在后台生成并返回 202，base 中的 url 为 None
+        """
+        class_obj = self.get_object()
+        detail, fmt = self._get_map_params(request)
+        data = class_obj.get_map_overlay()
+        data["base"] = get_base_map_manifest(request, detail, fmt)
+        if data["base"]["url"] is None:
+            return Response(data=data, status=status.HTTP_202_ACCEPTED, content_type="application/json")
+        return Response(data=data, content_type="application/json")
+
+    @action(detail=True, methods=["get"], url_path=r"map/districts/(?P<adcode>\d{6})",
+            renderer_classes=MAP_RENDERER_CLASSES)
+    def map_district(self, request, adcode, *args, **kwargs):
+        """
+        下钻到单个行政区：行政区及其直接下级的人数，边界从 maps/districts/<adcode>/ 获取
+        边界文件不在请求中生成：尚未生成时提交后台任务并返回 202，map 中的 url 为 None，稍后重新请求
+        """
+        class_obj = self.get_object()
+        detail, fmt = self._get_map_params(request)
+        children = get_district_children(adcode)
+        if children is None:
+            raise NotFound()
+        data = class_obj.get_district_overlay(adcode, children)
+        data["map"] = get_district_map_manifest(request, adcode, detail, fmt)
+        if data["map"]["url"] is None:
+            return Response(data=data, status=status.HTTP_202_ACCEPTED, content_type="application/json")
+        return Response(data=data, content_type="application/json")
 
 
 class ClassStudentViewSet(NestedViewSetMixin,
@@ -152,6 +272,7 @@ class ClassStudentViewSet(NestedViewSetMixin,
     lookup_field = 'user_role__user__id'
     queryset = ClassStudent.objects.all()
     permission_classes = [OnCurrentClassOrAdmin]
+    filter_backends = [PermissionFilter]
 
     def get_serializer_class(self):
         if self.action == "list":
@@ -186,6 +307,7 @@ class ClassTeacherViewSet(NestedViewSetMixin,
     lookup_field = 'user_role__user__id'
     queryset = ClassTeacher.objects.all()
     permission_classes = [OnCurrentClassOrAdmin]
+    filter_backends = [PermissionFilter]
 
     def get_serializer_class(self):
         if self.action == "list":
@@ -15,7 +15,8 @@ from rest_framework.response import Response
 
 from account.conf import settings
 from account.models.choices import UserRoleChoice
-from account.permissions import AdminSuper, CurrentUser, CurrentUserOrAdmin
+from account.permissions import AdminSuper, CurrentUser, CurrentUserOrAdmin, PermissionFilter
+from destination.utils.centers import get_city_centers
 
 User = get_user_model()
 
@@ -59,7 +60,8 @@ class UserViewSet(BaseUserViewSet):
     reset_username = None
     reset_username_confirm = None
 
-    filter_backends = [UserBaseFilter, SearchFilter]
+    # 不是管理员时只能获取自己的同学和老师
+    filter_backends = [PermissionFilter, UserBaseFilter, SearchFilter]
     search_fields = ["name", "=id"]
     pagination_class = UserPagination
     ordering_fields = ["name"]
@@ -74,15 +76,8 @@ class UserViewSet(BaseUserViewSet):
         super(BaseUserViewSet, self).permission_denied(request, **kwargs)
 
     def get_queryset(self):
-        user = self.request.user
-        queryset = super(BaseUserViewSet, self).get_queryset()
-        # warnings.warn("此处同班级获取用户的功能未实现", Warning)
-        if user.admin == 0:
-            # 理论上会在list操作上加权限设置
-            # 如果不是管理员，则只能获取自己的同学或者老师
-            queryset = self.request.user.get_classmates() | self.request.user.get_teachers()
-            # print(queryset.count())
-        return queryset
+        # 跳过 djoser 的 HIDE_USERS，可见范围由 PermissionFilter 按权限过滤
+        return super(BaseUserViewSet, self).get_queryset()
 
     def get_permissions(self):
         # if self.action == 'list':
@@ -93,7 +88,7 @@ class UserViewSet(BaseUserViewSet):
             self.permission_classes = [CurrentUserOrAdmin]
         elif self.action in ["role"]:
             self.permission_classes = [AdminSuper]
-        elif self.action == "has_nickname":
+        elif self.action in ["has_nickname", "nearby"]:
             self.permission_classes = [IsAuthenticated]
         elif self.action == "password_reset":
             self.permission_classes = [CurrentUser]
@@ -134,6 +129,8 @@ class UserViewSet(BaseUserViewSet):
                 raise ValidationError(f"{role=} 不在可选范围内")
         elif self.action == "password_reset":
             return settings.serializers.user_password_reset
+        elif self.action == "nearby":
+            return settings.serializers.user_private_simple
         raise NotImplementedError(f"Action {self.action} 未实现！")
 
     @action(["get"], detail=False)
@@ -161,6 +158,40 @@ class UserViewSet(BaseUserViewSet):
 
         return Response(data=data)
 
+    @action(detail=False, methods=["get"])
+    def nearby(self, request, *args, **kwargs):
+        """
+        去向城市的中心点在 km 公里以内的同学，按距离排序
+        默认以自己的去向城市为中心，也可以用 city 指定城市的adcode
+        """
+        try:
+            km = float(request.query_params.get("km", 100))
+            if not 0 < km <= 20000:
+                raise ValueError
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["km 必须是 0 到 20000 之间的数字"]})
+        user = request.user
+        adcode = request.query_params.get("city")
+        if adcode is None and user.role == UserRoleChoice.STUDENT and user.role_student.city_id is not None:
+            adcode = user.role_student.city.adcode
+        centers = get_city_centers()
+        center = centers.center(adcode) if adcode is not None else None
+        if center is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["没有可以作为中心的城市"]})
+
+        distances = centers.within(*center, km)
+        classmates = list(
+            user.get_classmates().exclude(pk=user.pk)
+            .filter(role_student__city__adcode__in=list(distances))
+            .select_related("role_student__city", "role_student__school")
+        )
+        data = []
+        for classmate, item in zip(classmates, self.get_serializer(classmates, many=True).data):
+            item["distance"] = round(distances[classmate.role_student.city.adcode], 1)
+            data.append(item)
+        data.sort(key=lambda item: item["distance"])
+        return Response(data={"center": adcode, "km": km, "results": data})
+
     @action(detail=False, methods=["get"])
     def has_nickname(self, request, *args, **kwargs):
         nickname = request.query_params.get("nickname", None)
@@ -31,6 +31,7 @@ router.register("classes", account.views.class_.ClassViewSet)
 router.register("apps", apps.views.AppViewSet)
 router.register("schools", destination.views.SchoolViewSet)
 router.register("cities", destination.views.CityViewSet)
+router.register("maps", destination.views.MapViewSet, basename="map")
 
 class_router = routers.NestedDefaultRouter(router, "classes", lookup="class")
 class_router.register("students", account.views.class_.ClassStudentViewSet)
@@ -69,7 +69,8 @@ def create_lazy_settings(DEFAULT_SETTINGS, SETTINGS_NAMESPACE, SETTINGS_TO_IMPOR
         if setting == SETTINGS_NAMESPACE:
             settings._setup(explicit_overriden_settings=value)
 
-    setting_changed.connect(reload_settings)
+    # reload_settings 是局部函数，弱引用会在返回后被回收，override_settings 就不会生效
+    setting_changed.connect(reload_settings, weak=False)
     return settings
 
 
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class DestinationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'destination'
+
+    def ready(self):
+        from destination import signals  # noqa: F401
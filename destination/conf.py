@@ -3,9 +3,51 @@ from django.conf import settings as django_settings
 
 from conf import create_lazy_settings
 
+# Django 只读取大写的设置，在 settings 中用 DESTINATION = {...} 覆盖下面的默认值
+SETTINGS_NAMESPACE = "DESTINATION"
+
 default_settings = {
     "KEY": "a2be9334d27020adf8e8f6962be84102",
-    "CLASS_MAPJSON_ROOT": django_settings.MEDIA_ROOT / "class_map"
+    # 高德行政区查询接口，测试时可以指向本地的替身服务器
+    "API_BASE_URL": "https://restapi.amap.com/v3/config/district",
+    # 预取行政区时的最大并发请求数
+    "PREFETCH_CONCURRENCY": 8,
+    # 离线行政区数据包（prefetch_districts 命令生成），本地没有的行政区先从这里取出
+    "DISTRICT_BUNDLE": None,
+    "CLASS_MAPJSON_ROOT": django_settings.MEDIA_ROOT / "class_map",
+    # 预编译的行政区边界数据，由 compile_districts 命令生成
+    "GEOMETRY_ROOT": django_settings.BASE_DIR / "destination" / "geometry",
+    # 地图边界的细节等级，tolerance 为 Douglas-Peucker 容差（度），digits 为坐标保留的小数位数，
+    # quantization 为 TopoJSON 的量化级数
+    "MAP_DETAILS": {
+        "low": {"tolerance": 0.05, "digits": 3, "quantization": 1e4},
+        "medium": {"tolerance": 0.01, "digits": 3, "quantization": 1e5},
+        "high": {"tolerance": 0.002, "digits": 4, "quantization": 1e5},
+        "full": {"tolerance": None, "digits": None, "quantization": 1e6},
+    },
+    # 城市列表，center 列为城市中心点
+    "CITIES_CSV": django_settings.BASE_DIR / "destination" / "data" / "cities.csv",
+    # 城市和学校数据的版本号在进程内保留的时间（秒），其他进程的修改最多延迟这么久才可见
+    "REFERENCE_VERSION_TTL": 5,
+    # 逆地理编码使用的边界细节等级
+    "GEOCODE_DETAIL": "high",
+    # 进程内缓存的行政区文件总大小（字节）
+    "DISTRICT_CACHE_BYTES": 256 * 1024 * 1024,
+    "MAP_DEFAULT_DETAIL": "low",
+    "MAP_FULL_DETAIL": "full",
+    # 班级去向统计的缓存时间（秒），统计平时由信号增量更新，这里只是兜底
+    "MAP_COUNTS_TIMEOUT": 43200,
+    # 地图文件预先压缩的版本，按优先级排列，br 需要安装 brotli
+    "MAP_ENCODINGS": ["br", "gzip"],
+    # 交给前端服务器发送文件：None 时由 Django 发送，"X-Accel-Redirect"（nginx）或 "X-Sendfile"（Apache、lighttpd）
+    "SENDFILE_HEADER": None,
+    # X-Accel-Redirect 的 internal location，指向 MEDIA_ROOT
+    "SENDFILE_URL": "/protected/",
+    # 后台任务执行器，测试时可以使用 destination.utils.jobs.LocalRunner
+    "JOB_RUNNER": "destination.utils.jobs.ThreadRunner",
+    "JOB_WORKERS": 2,
+    # 任务锁和任务状态的过期时间（秒）
+    "JOB_TIMEOUT": 600,
 }
 
-settings = create_lazy_settings(default_settings, "destination")
+settings = create_lazy_settings(default_settings, SETTINGS_NAMESPACE)
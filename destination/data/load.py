@@ -1,38 +1,83 @@
 # -*- coding: utf-8 -*-
+"""
+导入城市和学校数据
+
+CSV 分块读取，已有数据一次性读入内存比较，只把新增和变化的行用 bulk_create(update_conflicts=True) 写入，
+重复导入同一个文件不会修改数据库。bulk_create 不发送信号，有变化时自行更新缓存的版本号。
+"""
+from pathlib import Path
+
 import pandas as pd
+from django.db import transaction
 
 from destination.models import City, School
+from destination.utils.reference import bump_version
 
+DATA_DIR = Path(__file__).resolve().parent
 
-def load_cities(fp="cities.csv"):
-    cities = pd.read_csv(fp)
-    for index, row in cities.iterrows():
-        City.objects.update_or_create(
-            name=row["name"],
-            defaults={
-                "adcode": row["adcode"],
-            },
-            create_defaults={
-                "name": row["name"],
-                "adcode": row["adcode"]
-            }
-        )
+
+def _read_csv(fp, chunksize):
+    return pd.read_csv(fp, dtype=str, keep_default_na=False, chunksize=chunksize, encoding="utf-8-sig")
 
 
-def load_schools(fp="schools.csv"):
-    schools = pd.read_csv(fp)
-    for index, row in schools.iterrows():
-        print(row["学校名称"], row["所在地"])
-        city = City.objects.get(name=row["所在地"])
-        School.objects.update_or_create(
-            id=row["学校标识码"],
-            defaults={
-                "name": row["学校名称"],
-                "city": city
-            },
-            create_defaults={
-                "id": row["学校标识码"],
-                "name": row["学校名称"],
-                "city": city
-            }
+def _upsert(model, rows, existing, update_fields):
+    """
+    :param rows: {主键: 字段}，来自 CSV
+    :param existing: {主键: 字段}，数据库中已有的数据，写入后同步更新
+    :return: (新增数, 更新数, 未变化数)
+    """
+    inserted = [pk for pk in rows if pk not in existing]
+    updated = [pk for pk in rows if pk in existing and existing[pk] != rows[pk]]
+    changed = inserted + updated
+    if changed:
+        model.objects.bulk_create(
+            [model(pk=pk, **rows[pk]) for pk in changed],
+            update_conflicts=True,
+            unique_fields=[model._meta.pk.name],
+            update_fields=update_fields,
         )
+        existing.update({pk: rows[pk] for pk in changed})
+    return len(inserted), len(updated), len(rows) - len(changed)
+
+
+def load_cities(fp=DATA_DIR / "cities.csv", chunksize=1000):
+    """
+    :return: {"inserted": 新增数, "updated": 更新数, "unchanged": 未变化数}
+    """
+    stats = {"inserted": 0, "updated": 0, "unchanged": 0}
+    with transaction.atomic():
+        existing = {name: {"adcode": adcode} for name, adcode in City.objects.values_list("name", "adcode")}
+        for chunk in _read_csv(fp, chunksize):
+            rows = {row.name: {"adcode": row.adcode} for row in chunk.itertuples(index=False)}
+            for key, value in zip(stats, _upsert(City, rows, existing, ["adcode"])):
+                stats[key] += value
+    if stats["inserted"] or stats["updated"]:
+        bump_version()
+    return stats
+
+
+def load_schools(fp=DATA_DIR / "schools.csv", chunksize=1000):
+    """
+    :return: {"inserted": 新增数, "updated": 更新数, "unchanged": 未变化数, "missing": 所在地不存在的学校}
+    """
+    stats = {"inserted": 0, "updated": 0, "unchanged": 0, "missing": []}
+    with transaction.atomic():
+        # 城市的主键就是名字
+        cities = set(City.objects.values_list("name", flat=True))
+        existing = {
+            pk: {"name": name, "city_id": city_id}
+            for pk, name, city_id in School.objects.values_list("id", "name", "city_id")
+        }
+        for chunk in _read_csv(fp, chunksize):
+            rows = {}
+            for school_id, name, city in zip(chunk["学校标识码"], chunk["学校名称"], chunk["所在地"]):
+                if city not in cities:
+                    stats["missing"].append(name)
+                    continue
+                rows[school_id] = {"name": name, "city_id": city}
+            for key, value in zip(["inserted", "updated", "unchanged"],
+                                  _upsert(School, rows, existing, ["name", "city"])):
+                stats[key] += value
+    if stats["inserted"] or stats["updated"]:
+        bump_version()
+    return stats
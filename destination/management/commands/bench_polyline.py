@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from destination.utils.geo import fetch_district, parse_polyline, polyline_to_multipolygon, string_to_point
+
+
+def legacy_parse_polyline(polyline: str):
+    return [[string_to_point(x) for x in polygon.split(";")] for polygon in polyline.split("|")]
+
+
+def legacy_polyline_to_multipolygon(polyline: str):
+    """原先逐点解析的实现，作为对照"""
+    ret = {
+        "type": "MultiPolygon",
+        "coordinates": []
+    }
+    for polygon in polyline.split("|"):
+        ret["coordinates"].append([[string_to_point(x) for x in polygon.split(";")]])
+    return ret
+
+
+class Command(BaseCommand):
+    help = "对比 polyline 解析的新旧实现"
+
+    def add_arguments(self, parser):
+        parser.add_argument("adcodes", nargs="*", default=["100000"], help="用于测试的行政区adcode")
+        parser.add_argument("-n", "--number", type=int, default=5, help="每个实现的运行次数")
+
+    def handle(self, *args, **options):
+        number = options["number"]
+        for adcode in options["adcodes"]:
+            polyline = fetch_district(adcode, 0)["polyline"]
+            if json.dumps(polyline_to_multipolygon(polyline)) != json.dumps(legacy_polyline_to_multipolygon(polyline)):
+                self.stderr.write(self.style.ERROR(f"{adcode}: 输出与原实现不一致"))
+                continue
+            self.stdout.write(f"{adcode}: {polyline.count(';') + polyline.count('|') + 1} 个点")
+            for name, legacy_func, func in [
+                ("解析", legacy_parse_polyline, parse_polyline),
+                ("GeoJSON", legacy_polyline_to_multipolygon, polyline_to_multipolygon),
+            ]:
+                legacy = timeit.timeit(lambda: legacy_func(polyline), number=number) / number
+                current = timeit.timeit(lambda: func(polyline), number=number) / number
+                self.stdout.write(
+                    f"  {name}: 原实现 {legacy * 1000:.2f}ms，当前 {current * 1000:.2f}ms，{legacy / current:.1f}x"
+                )
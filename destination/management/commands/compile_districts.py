@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from destination.conf import settings
+from destination.utils.geo import iter_compile_districts
+from destination.utils.store import compile_store, reset_store
+
+
+class Command(BaseCommand):
+    help = "将行政区边界编译为可 mmap 加载的二进制数据"
+
+    def handle(self, *args, **options):
+        stores = compile_store(iter_compile_districts(), settings.GEOMETRY_ROOT, settings.MAP_DETAILS)
+        reset_store()
+        for detail, store in stores.items():
+            self.stdout.write(self.style.SUCCESS(
+                f"{detail}: 已编译 {len(store.districts)} 个行政区，{len(store.rings) - 1} 个环，"
+                f"{len(store.coords)} 个坐标点，版本 {store.version}"
+            ))
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from destination.utils.bundle import install_bundle
+from destination.utils.geo import DISTRICTS_DIR
+
+
+class Command(BaseCommand):
+    help = "安装 prefetch_districts 生成的离线数据包"
+
+    def add_arguments(self, parser):
+        parser.add_argument("bundle", help="数据包路径")
+        parser.add_argument("--overwrite", action="store_true", help="覆盖本地已有的文件")
+
+    def handle(self, *args, **options):
+        manifest, installed = install_bundle(options["bundle"], DISTRICTS_DIR, options["overwrite"])
+        self.stdout.write(self.style.SUCCESS(
+            f"已安装数据包 {manifest['version']}（{manifest['created']}），"
+            f"写入 {installed} 个文件，共 {len(manifest['files'])} 个"
+        ))
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from destination.data.load import DATA_DIR, load_cities, load_schools
+
+
+class Command(BaseCommand):
+    help = "导入城市和学校数据，可以重复执行"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cities", type=Path, default=DATA_DIR / "cities.csv", help="城市 CSV")
+        parser.add_argument("--schools", type=Path, default=DATA_DIR / "schools.csv", help="学校 CSV")
+        parser.add_argument("--chunksize", type=int, default=1000, help="每次读取的行数")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        for label, load, fp in [("城市", load_cities, options["cities"]), ("学校", load_schools, options["schools"])]:
+            stats = load(fp, options["chunksize"])
+            self.stdout.write(self.style.SUCCESS(
+                f"{label}：新增 {stats['inserted']}，更新 {stats['updated']}，未变化 {stats['unchanged']}"
+            ))
+            for name in stats.get("missing", []):
+                self.stdout.write(self.style.WARNING(f"{name} 的所在地不存在，已跳过"))
+        self.stdout.write(f"耗时 {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from destination.conf import settings
+from destination.utils.bundle import write_bundle
+from destination.utils.geo import DISTRICTS_DIR
+from destination.utils.prefetch import prefetch_districts
+
+
+class Command(BaseCommand):
+    help = "并发预取所有省级行政区和城市的边界，并打包为离线数据包"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-c", "--concurrency", type=int, default=settings.PREFETCH_CONCURRENCY,
+                            help="最大并发请求数")
+        parser.add_argument("--bundle", type=Path, help="数据包的输出目录，不指定时只预取")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        stats = prefetch_districts(options["concurrency"])
+        self.stdout.write(self.style.SUCCESS(
+            f"请求了 {stats['fetched']} 个行政区，本地已有 {stats['cached']} 个，耗时 {time.perf_counter() - start:.2f}s"
+        ))
+        if options["bundle"] is not None:
+            path, manifest = write_bundle(DISTRICTS_DIR, options["bundle"])
+            self.stdout.write(self.style.SUCCESS(
+                f"已打包 {len(manifest['files'])} 个文件到 {path}，版本 {manifest['version']}"
+            ))
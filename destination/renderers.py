@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+
+class GeoJSONRenderer(JSONRenderer):
+    """
+    仅用于内容协商，使 ?format=geojson 可用
+    """
+    media_type = "application/geo+json"
+    format = "geojson"
+
+
+class TopoJSONRenderer(JSONRenderer):
+    """
+    仅用于内容协商，?format=topojson 或 Accept: application/topo+json 时地图以 TopoJSON 格式给出
+    """
+    media_type = "application/topo+json"
+    format = "topojson"
+
+
+def get_map_format(request):
+    """
+    :return: "topojson" 或 "geojson"
+    """
+    renderer = getattr(request, "accepted_renderer", None)
+    if renderer is not None and renderer.format == TopoJSONRenderer.format:
+        return "topojson"
+    return "geojson"
+
+
+# 地图相关的接口在默认渲染器之外支持 TopoJSON
+MAP_RENDERER_CLASSES = [*api_settings.DEFAULT_RENDERER_CLASSES, GeoJSONRenderer, TopoJSONRenderer]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+城市或学校变化时更新缓存的版本号，批量导入不会发送信号，由 destination.data.load 自行更新
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from destination.models import City, School
+from destination.utils.reference import bump_version
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+@receiver(post_save, sender=School)
+@receiver(post_delete, sender=School)
+def reference_changed(sender, **kwargs):
+    transaction.on_commit(bump_version)
@@ -1,3 +1,331 @@
-from django.test import TestCase
+import gc
+import json
+import math
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from conf import create_lazy_settings
+from destination.conf import settings as destination_settings
+from destination.models import City, School
+from destination.utils import geo
+from destination.utils.geo import aggregate_destination_counts, district_to_feature, iter_compile_districts, \
+    parse_polyline, polyline_to_multipolygon, simplify_rings, string_to_point
+from destination.utils.maps import build_map_assets, find_base_map_asset, find_district_map_asset
+from destination.utils.prefetch import prefetch_districts
+from destination.utils.reference import VERSION_CACHE_KEY, bump_version, get_version
+from destination.utils.store import compile_store, get_store
+
+
+def square(adcode, name, level, lon, lat, size=1.0):
+    """
+    :return: 边界为正方形的行政区，格式与高德接口相同
+    """
+    corners = [(lon, lat), (lon + size, lat), (lon + size, lat + size), (lon, lat + size), (lon, lat)]
+    return {
+        "adcode": adcode, "name": name, "level": level, "center": f"{lon + size / 2},{lat + size / 2}",
+        "polyline": ";".join(f"{x},{y}" for x, y in corners), "districts": [],
+    }
+
+
+def circle(lon, lat, radius, n=200):
+    return ";".join(
+        f"{lon + radius * math.cos(2 * math.pi * i / n):.6f},{lat + radius * math.sin(2 * math.pi * i / n):.6f}"
+        for i in range(n + 1)
+    )
+
+
+def outline(adcode, name, level, lon, lat, radius, children=()):
+    """
+    :return: 边界为一个大圆和一个小岛的行政区
+    """
+    return {
+        "adcode": adcode, "name": name, "level": level, "center": f"{lon},{lat}",
+        "polyline": circle(lon, lat, radius) + "|" + circle(lon + 2 * radius, lat, radius / 20, 20),
+        "districts": [{"adcode": child["adcode"], "name": child["name"], "level": child["level"],
+                       "center": child["center"], "districts": []} for child in children],
+    }
+
+
+class DistrictFixtureMixin:
+    """
+    国家 -> 北京市、天津市、河北省 -> 石家庄市、唐山市，行政区文件写在临时目录中，不访问高德的接口
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        root = Path(directory.name)
+        (root / "districts").mkdir()
+        (root / "geometry").mkdir()
+        (root / "media").mkdir()
+        districts_dir = mock.patch.object(geo, "DISTRICTS_DIR", root / "districts")
+        districts_dir.start()
+        self.addCleanup(districts_dir.stop)
+        overrides = override_settings(
+            MEDIA_ROOT=root / "media",
+            DESTINATION={"GEOMETRY_ROOT": root / "geometry", "API_BASE_URL": "http://127.0.0.1:9/"},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # 覆盖没有生效时会写入源码目录中的 destination/geometry，或者访问高德的接口
+        self.assertEqual(destination_settings.GEOMETRY_ROOT, root / "geometry")
+        self.assertEqual(destination_settings.API_BASE_URL, "http://127.0.0.1:9/")
+
+        beijing = outline("110000", "北京市", "province", 116.4, 39.9, 0.5)
+        tianjin = outline("120000", "天津市", "province", 117.2, 39.1, 0.4)
+        shijiazhuang = outline("130100", "石家庄市", "city", 114.5, 38.0, 0.6)
+        tangshan = outline("130200", "唐山市", "city", 118.2, 39.6, 0.6)
+        hebei = outline("130000", "河北省", "province", 115.5, 38.5, 2.0, [shijiazhuang, tangshan])
+        country = outline("100000", "中华人民共和国", "country", 116.3, 39.9, 20, [beijing, tianjin, hebei])
+        files = {
+            "100000_1_all": country, "110000_0_all": beijing, "120000_0_all": tianjin, "130000_1_all": hebei,
+            "130100_0_all": shijiazhuang, "130200_0_all": tangshan,
+        }
+        for name, district in files.items():
+            (root / "districts" / f"{name}.json").write_text(json.dumps(district))
+        self.districts = files
+        self.districts_dir = root / "districts"
+
+
+class GeometryPipelineTests(DistrictFixtureMixin, TestCase):
+    def test_parse_polyline(self):
+        polyline = self.districts["110000_0_all"]["polyline"]
+        rings = parse_polyline(polyline)
+        self.assertEqual([len(ring) for ring in rings], [201, 21])
+        # 与逐个点解析的结果相同
+        expected = [[list(string_to_point(point)) for point in ring.split(";")] for ring in polyline.split("|")]
+        self.assertEqual([ring.tolist() for ring in rings], expected)
+        with self.assertRaises(ValueError):
+            parse_polyline("116.1,39.1;116.2")
+
+    def test_simplify_rings(self):
+        rings = parse_polyline(self.districts["110000_0_all"]["polyline"])
+        self.assertIs(simplify_rings(rings, "full"), rings)
+        simplified = simplify_rings(rings, "low")
+        self.assertLess(len(simplified[0]), len(rings[0]))
+        self.assertTrue((simplified[0][0] == simplified[0][-1]).all())
+        # 简化后所有环都退化时至少保留最大的环
+        tiny = parse_polyline(circle(116, 39, 0.001, 20))
+        self.assertEqual(len(simplify_rings(tiny, "low")), 1)
+
+    def test_aggregate_destination_counts(self):
+        counts = aggregate_destination_counts([
+            {"city__adcode": "130100", "school_id": "1", "count": 2},
+            {"city__adcode": "130200", "school_id": None, "count": 1},
+            {"city__adcode": "120000", "school_id": "1", "count": 1},
+            {"city__adcode": None, "school_id": None, "count": 3},
+        ])
+        self.assertEqual(counts["cities"], {"130100": 2, "130200": 1, "120000": 1})
+        self.assertEqual(counts["provinces"], {"130000": 3, "120000": 1})
+        self.assertEqual(counts["schools"], {"1": 3})
+
+    def test_store_matches_polyline(self):
+        compile_store(iter_compile_districts(), destination_settings.GEOMETRY_ROOT, ["low", "full"])
+        self.assertEqual(set(get_store("full").districts), {name.split("_")[0] for name in self.districts})
+        for detail in ["low", "full"]:
+            for name, district in self.districts.items():
+                self.assertEqual(
+                    district_to_feature(district, detail)["geometry"],
+                    polyline_to_multipolygon(district["polyline"], detail)
+                )
+
+    def test_map_assets(self):
+        client = APIClient()
+        self.assertEqual(build_map_assets(["low"], ["geojson", "topojson"], districts=True), 2 * (1 + 6))
+        response = client.get("/maps/base/", {"detail": "low"})
+        self.assertEqual(response.status_code, 200)
+        asset = client.get(response.data["url"])
+        self.assertEqual(asset.status_code, 200)
+        features = json.loads(b"".join(asset.streaming_content))["features"]
+        self.assertEqual([feature["properties"]["adcode"] for feature in features], ["110000", "120000", "130000"])
+
+        response = client.get("/maps/districts/130000/", {"detail": "low", "format": "topojson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.get(response.data["url"]).status_code, 200)
+        self.assertEqual(client.get("/maps/districts/999999/").status_code, 404)
+
+
+class PrefetchTests(DistrictFixtureMixin, TestCase):
+    """
+    高德接口的替身服务器返回夹具中的行政区，每个请求停留一段时间，统计同时处理的请求数
+    """
+
+    def setUp(self):
+        super().setUp()
+        # 夹具改由替身服务器提供
+        for path in self.districts_dir.iterdir():
+            path.unlink()
+        self.requests, self.in_flight, self.max_in_flight = [], 0, 0
+        lock = threading.Lock()
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = {key: value[0] for key, value in parse_qs(urlparse(self.path).query).items()}
+                with lock:
+                    test.requests.append((params["keywords"], params["subdistrict"]))
+                    test.in_flight += 1
+                    test.max_in_flight = max(test.max_in_flight, test.in_flight)
+                time.sleep(0.05)
+                with lock:
+                    test.in_flight -= 1
+                district = test.districts.get(f"{params['keywords']}_{params['subdistrict']}_{params['extensions']}")
+                body = json.dumps(
+                    {"status": "1", "districts": [district]} if district else {"status": "0", "info": "INVALID"}
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        overrides = override_settings(DESTINATION={
+            "GEOMETRY_ROOT": destination_settings.GEOMETRY_ROOT,
+            "API_BASE_URL": f"http://127.0.0.1:{server.server_port}/v3/config/district",
+            "PREFETCH_CONCURRENCY": 2,
+        })
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_prefetch(self):
+        self.assertEqual(prefetch_districts(), {"fetched": 6, "cached": 0})
+        self.assertEqual(
+            sorted(path.stem for path in self.districts_dir.iterdir()),
+            sorted(self.districts)
+        )
+        for name, district in self.districts.items():
+            self.assertEqual(json.loads((self.districts_dir / f"{name}.json").read_text()), district)
+        # 三个省级行政区同时请求，受 PREFETCH_CONCURRENCY 限制
+        self.assertEqual(self.max_in_flight, 2)
+
+        # 本地已有的行政区不再请求
+        self.assertEqual(prefetch_districts(), {"fetched": 0, "cached": 6})
+        self.assertEqual(len(self.requests), 6)
+
+    def test_concurrency_argument(self):
+        prefetch_districts(concurrency=1)
+        self.assertEqual(self.max_in_flight, 1)
+
+
+class MapAssetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.client = APIClient()
+
+    def test_unknown_digest_does_not_build(self):
+        self.assertEqual(self.client.get("/maps/base/low/0123abcd/").status_code, 404)
+        self.assertEqual(self.client.get("/maps/districts/110000/low/0123abcd/").status_code, 404)
+        self.assertEqual(self.client.get("/maps/base/unknown/0123abcd/").status_code, 404)
+        self.assertIsNone(find_base_map_asset("low"))
+        self.assertIsNone(find_district_map_asset("110000", "low"))
+
+
+class SettingsTests(TestCase):
+    def test_reload_receiver_is_kept(self):
+        # 接收 setting_changed 的局部函数不能被回收，否则 override_settings 不会生效
+        lazy_settings = create_lazy_settings({"VALUE": 1}, "LAZY_SETTINGS_TEST")
+        gc.collect()
+        with override_settings(LAZY_SETTINGS_TEST={"VALUE": 2}):
+            self.assertEqual(lazy_settings.VALUE, 2)
+        self.assertEqual(lazy_settings.VALUE, 1)
+
+    def test_override(self):
+        default = destination_settings.JOB_TIMEOUT
+        with override_settings(DESTINATION={"JOB_TIMEOUT": 5}):
+            self.assertEqual(destination_settings.JOB_TIMEOUT, 5)
+            self.assertEqual(destination_settings.JOB_WORKERS, 2)
+        self.assertEqual(destination_settings.JOB_TIMEOUT, default)
+
+
+class AutocompleteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        beijing = City.objects.create(name="北京市", adcode="110000")
+        School.objects.create(id="4111010001", name="北京大学", city=beijing)
+        School.objects.create(id="4111010003", name="清华大学", city=beijing)
+
+    def setUp(self):
+        # TestCase 中不会提交事务，不会触发 destination.signals
+        bump_version()
+
+    def search(self, q):
+        response = APIClient().get("/schools/autocomplete/", {"q": q})
+        return [item["name"] for item in response.data["results"]]
+
+    def test_chinese_and_pinyin(self):
+        self.assertEqual(self.search("北京"), ["北京大学"])
+        self.assertEqual(self.search("qinghua"), ["清华大学"])
+        self.assertEqual(self.search("bjdx"), ["北京大学"])
+
+
+class ReferenceVersionTests(TestCase):
+    def test_version_is_kept_in_process(self):
+        bump_version()
+        version = get_version()
+        # 其他进程更新了版本号
+        cache.set(VERSION_CACHE_KEY, "other", None)
+        with override_settings(DESTINATION={"REFERENCE_VERSION_TTL": 60}):
+            self.assertEqual(destination_settings.REFERENCE_VERSION_TTL, 60)
+            self.assertEqual(get_version(), version)
+        with override_settings(DESTINATION={"REFERENCE_VERSION_TTL": 0}):
+            self.assertEqual(destination_settings.REFERENCE_VERSION_TTL, 0)
+            self.assertEqual(get_version(), "other")
+
+    def test_bump_is_visible_immediately(self):
+        version = get_version()
+        bump_version()
+        self.assertNotEqual(get_version(), version)
+
+
+class GeometryStoreTests(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = Path(root.name)
+        geometry_root = override_settings(DESTINATION={"GEOMETRY_ROOT": self.root})
+        geometry_root.enable()
+        self.addCleanup(geometry_root.disable)
+        self.assertEqual(destination_settings.GEOMETRY_ROOT, self.root)
+
+    def compile(self, size):
+        return compile_store([(square("110000", "北京市", "province", 116, 39, size), None)], self.root, ["full"])
+
+    def test_not_compiled(self):
+        self.assertIsNone(get_store("full"))
+
+    def test_reopen_after_recompile(self):
+        self.compile(1.0)
+        store = get_store("full")
+        self.assertIs(get_store("full"), store)
+        old_ring = store.ring_arrays("110000")[0]
+
+        self.compile(2.0)
+        new_store = get_store("full")
+        self.assertNotEqual(new_store.version, store.version)
+        self.assertEqual(new_store.ring_arrays("110000")[0][2].tolist(), [118.0, 41.0])
+        # 旧版本的文件已被删除，已经打开的数据仍然可以读取
+        self.assertEqual(len(list(self.root.glob("full/*.npy"))), 2)
+        self.assertEqual(old_ring[2].tolist(), [117.0, 40.0])
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+学校和城市的输入提示
+
+表很小而且几乎不变，索引整体放在内存中：
+    中文：名字的一元和二元组 -> 条目，查询时取各个组的交集，再确认是子串
+    拼音：全拼和首字母的前缀 -> 条目
+数据来自 destination.utils.reference，城市和学校变化后各进程在下次查询时重建。
+"""
+import heapq
+
+from pypinyin import Style, lazy_pinyin
+
+from destination.utils.reference import get_reference
+
+MAX_PREFIX = 12
+
+
+def _grams(text):
+    return {text[i:i + n] for n in (1, 2) for i in range(len(text) - n + 1)}
+
+
+def _spellings(name):
+    """
+    :return: 名字的全拼和首字母
+    """
+    return [
+        "".join(lazy_pinyin(name, errors="ignore")).lower(),
+        "".join(lazy_pinyin(name, style=Style.FIRST_LETTER, errors="ignore")).lower(),
+    ]
+
+
+class AutocompleteIndex:
+    def __init__(self, entries):
+        """
+        :param entries: 可迭代的 (名字, 返回给客户端的数据)
+        """
+        self.names, self.items, self.spellings = [], [], []
+        self.grams, self.prefixes = {}, {}
+        for i, (name, item) in enumerate(entries):
+            self.names.append(name.lower())
+            self.items.append(item)
+            spellings = _spellings(name)
+            self.spellings.append(spellings)
+            for gram in _grams(name.lower()):
+                self.grams.setdefault(gram, set()).add(i)
+            for spelling in spellings:
+                for n in range(1, min(len(spelling), MAX_PREFIX) + 1):
+                    self.prefixes.setdefault(spelling[:n], set()).add(i)
+
+    def _rank(self, i, query):
+        """
+        排序：名字完全相同 < 名字以 query 开头 < 名字包含 query（越靠前越好）< 拼音匹配，同类中名字短的在前
+        """
+        name = self.names[i]
+        position = name.find(query)
+        if position == 0:
+            kind = 0 if name == query else 1
+        elif position > 0:
+            kind = 2
+        else:
+            kind, position = 3, 0
+        return kind, position, len(name), name
+
+    def search(self, query, k=10):
+        """
+        :return: 最多 k 个匹配的条目
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        candidates = set()
+        grams = [self.grams.get(gram, set()) for gram in _grams(query) if len(gram) == min(len(query), 2)]
+        if grams:
+            candidates = set.intersection(*grams)
+            candidates = {i for i in candidates if query in self.names[i]}
+        if query.isascii():
+            matched = self.prefixes.get(query[:MAX_PREFIX], set())
+            if len(query) > MAX_PREFIX:
+                matched = {i for i in matched if any(s.startswith(query) for s in self.spellings[i])}
+            candidates |= matched
+        return [self.items[i] for i in heapq.nsmallest(k, candidates, key=lambda i: self._rank(i, query))]
+
+
+def _school_entries(reference):
+    for school in reference.schools:
+        yield school.name, {"name": school.name, "city": school.city_id, "id": school.id}
+
+
+def _city_entries(reference):
+    for city in reference.cities:
+        yield city.name, {"name": city.name, "adcode": city.adcode}
+
+
+_builders = {
+    "school": _school_entries,
+    "city": _city_entries,
+}
+_indexes = {}
+
+
+def get_index(kind):
+    """
+    :param kind: school 或 city
+    :return: 当前进程的索引，城市和学校变化后自动重建
+    """
+    reference = get_reference()
+    index = _indexes.get(kind)
+    if index is None or index[0] != reference.version:
+        index = (reference.version, AutocompleteIndex(_builders[kind](reference)))
+        _indexes[kind] = index
+    return index[1]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+离线行政区数据包
+
+将行政区目录中的文件打包为 zip，附带 manifest.json：
+    {"version": 内容哈希, "created": 打包时间, "files": {文件名: {"sha256": ..., "size": ...}}}
+新部署的节点安装数据包后不需要访问高德的接口。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from datetime import datetime
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _replace(path, data):
+    """
+    原子地写入文件，读取者不会看到写了一半的文件
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_bundle(directory, output):
+    """
+    :param directory: 行政区目录
+    :param output: 数据包所在的目录，文件名为 districts.<version>.zip
+    :return: (数据包路径, manifest)
+    """
+    files = {}
+    for path in sorted(directory.glob("*.json")):
+        data = path.read_bytes()
+        files[path.name] = {"sha256": _sha256(data), "size": len(data)}
+    version = _sha256(json.dumps(files, sort_keys=True).encode())[:16]
+    manifest = {"version": version, "created": datetime.now().isoformat(timespec="seconds"), "files": files}
+
+    output.mkdir(exist_ok=True, parents=True)
+    path = output / f"districts.{version}.zip"
+    fd, tmp_path = tempfile.mkstemp(dir=output, prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            bundle.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+            for name in files:
+                bundle.write(directory / name, name)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path, manifest
+
+
+def read_manifest(bundle):
+    with zipfile.ZipFile(bundle) as f:
+        return json.loads(f.read(MANIFEST_NAME))
+
+
+def _read_member(bundle, manifest, name):
+    """
+    :return: 校验过哈希的文件内容
+    """
+    data = bundle.read(name)
+    if _sha256(data) != manifest["files"][name]["sha256"]:
+        raise ValueError(f"数据包中的 {name} 已损坏")
+    return data
+
+
+def install_bundle(bundle_path, directory, overwrite=False):
+    """
+    将数据包解压到行政区目录
+    :param overwrite: 是否覆盖已有的文件
+    :return: (manifest, 写入的文件数)
+    """
+    directory.mkdir(exist_ok=True, parents=True)
+    installed = 0
+    with zipfile.ZipFile(bundle_path) as bundle:
+        manifest = json.loads(bundle.read(MANIFEST_NAME))
+        for name in manifest["files"]:
+            path = directory / name
+            if path.exists() and not overwrite:
+                continue
+            _replace(path, _read_member(bundle, manifest, name))
+            installed += 1
+    return manifest, installed
+
+
+def extract_member(bundle_path, name, directory):
+    """
+    从数据包中取出单个文件
+    :return: 数据包中是否有这个文件
+    """
+    if bundle_path is None or not os.path.exists(bundle_path):
+        return False
+    with zipfile.ZipFile(bundle_path) as bundle:
+        manifest = json.loads(bundle.read(MANIFEST_NAME))
+        if name not in manifest["files"]:
+            return False
+        _replace(directory / name, _read_member(bundle, manifest, name))
+    return True
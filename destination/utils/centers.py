@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+城市中心点
+
+cities.csv 中所有城市的中心点保存在一个 (N, 2) 的数组中，按经纬度登记到规则网格里。
+按半径查询时只取出覆盖范围内格子中的城市，再用向量化的 haversine 公式计算距离。
+"""
+import csv
+import math
+
+import numpy as np
+
+from destination.conf import settings
+
+EARTH_RADIUS = 6371.0088
+
+
+def haversine(lon, lat, lons, lats):
+    """
+    :param lon: 起点经度
+    :param lat: 起点纬度
+    :param lons: 终点经度数组
+    :param lats: 终点纬度数组
+    :return: 距离数组（km）
+    """
+    lon, lat, lons, lats = map(np.radians, (lon, lat, lons, lats))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class CityCenters:
+    def __init__(self, adcodes, coords, cell_size=1.0):
+        """
+        :param adcodes: 城市的 adcode
+        :param coords: (N, 2) 的经纬度
+        :param cell_size: 网格的边长（度）
+        """
+        self.adcodes = list(adcodes)
+        self.index = {adcode: i for i, adcode in enumerate(self.adcodes)}
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = cell_size
+        cells = np.floor(self.coords / cell_size).astype(np.int64)
+        grid = {}
+        for i, cell in enumerate(map(tuple, cells.tolist())):
+            grid.setdefault(cell, []).append(i)
+        self.grid = {cell: np.asarray(ids, dtype=np.int64) for cell, ids in grid.items()}
+
+    @classmethod
+    def from_csv(cls, fp):
+        adcodes, coords = [], []
+        with open(fp, encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                adcodes.append(row["adcode"])
+                coords.append([float(x) for x in row["center"].split(",")])
+        return cls(adcodes, coords)
+
+    def center(self, adcode):
+        """
+        :return: (经度, 纬度)，没有该城市时返回 None
+        """
+        i = self.index.get(str(adcode))
+        return None if i is None else tuple(self.coords[i].tolist())
+
+    def _candidates(self, lon, lat, km):
+        # 1 度纬度约 111km，经度方向按纬度缩放，高纬度时退化为整圈
+        dlat = km / 111.0
+        cos = math.cos(math.radians(min(abs(lat) + dlat, 89.0)))
+        dlon = min(km / (111.0 * cos), 180.0)
+        x0, x1 = math.floor((lon - dlon) / self.cell_size), math.floor((lon + dlon) / self.cell_size)
+        y0, y1 = math.floor((lat - dlat) / self.cell_size), math.floor((lat + dlat) / self.cell_size)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.grid):
+            return np.arange(len(self.adcodes))
+        ids = [
+            self.grid[x, y] for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in self.grid
+        ]
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+
+    def within(self, lon, lat, km):
+        """
+        :return: {adcode: 距离}，中心点在半径 km 以内的城市
+        """
+        ids = self._candidates(lon, lat, km)
+        distances = haversine(lon, lat, self.coords[ids, 0], self.coords[ids, 1])
+        mask = distances <= km
+        return {self.adcodes[i]: d for i, d in zip(ids[mask].tolist(), distances[mask].tolist())}
+
+    def nearest(self, lon, lat):
+        """
+        :return: (adcode, 距离)，中心点离 (lon, lat) 最近的城市
+        """
+        km = 50.0
+        while True:
+            found = self.within(lon, lat, km)
+            if found or km > 2 * math.pi * EARTH_RADIUS:
+                break
+            km *= 2
+        if not found:
+            return None
+        return min(found.items(), key=lambda item: item[1])
+
+
+_centers = None
+
+
+def get_city_centers():
+    """
+    :return: 当前进程的 CityCenters
+    """
+    global _centers
+    if _centers is None:
+        _centers = CityCenters.from_csv(settings.CITIES_CSV)
+    return _centers
@@ -2,11 +2,13 @@
 import json
 
 import httpx
+import numpy as np
 from django.conf import settings as django_settings
 
 from destination.conf import settings
-
-API_BASE_URL = 'https://restapi.amap.com/v3/config/district'
+from destination.utils.bundle import extract_member
+from destination.utils.lru import FileCache
+from destination.utils.store import get_store
 
 DISTRICTS_DIR = django_settings.BASE_DIR / "destination" / "districts"
 # GEOJSON_DIR = django_settings.BASE_DIR / "destination" / "geojson"
@@ -14,32 +16,111 @@ DISTRICTS_DIR = django_settings.BASE_DIR / "destination" / "districts"
 # GEOJSON_DIR.mkdir(mode=0o644, exist_ok=True, parents=True)
 DISTRICTS_DIR.mkdir(mode=0o644, exist_ok=True, parents=True)
 
+# 已解析的行政区文件，同一个进程中多次生成地图时不再重复读取和解析
+district_cache = FileCache(settings.DISTRICT_CACHE_BYTES)
+
+# 四个直辖市和两个特别行政区，它们在地图上按省级整体统计
+SPECIAL_ADCODES = [
+    "310000",  # 上海市
+    "500000",  # 重庆市
+    "810000",  # 香港特别行政区
+    "820000",  # 澳门特别行政区
+    "110000",  # 北京市
+    "120000",  # 天津市
+]
+
 
 def get_district(adcode, subdistrict=1, extensions="all"):
     """
-    获取行政区信息 https://lbs.amap.com/api/webservice/guide/api/district
+    获取行政区信息，优先使用预编译的边界数据（见 destination.utils.store），此时用 rings 代替 polyline
     :param adcode: 行政图adcode
-    :param subdistrict: 设置显示下级行政区级数（行政区级别包括：国家、省/直辖市、市、区/县、乡镇/街道多级数据）
+    :param subdistrict: 设置显示下级行政区级数
     :param extensions: base:不返回行政区边界坐标点；all:只返回当前查询 district 的边界值
     :return: 行政区的json
     """
-    fp = DISTRICTS_DIR / f"{adcode}_{subdistrict}_{extensions}.json"
-    if fp.exists():
-        return json.loads(fp.read_text())
-    resp = httpx.get(API_BASE_URL, params={
+    store = get_store()
+    if store is not None and extensions == "all":
+        district = store.get_district(adcode, subdistrict)
+        if district is not None:
+            return district
+    return fetch_district(adcode, subdistrict, extensions)
+
+
+def fetch_district(adcode, subdistrict=1, extensions="all"):
+    """
+    获取高德原始的行政区信息 https://lbs.amap.com/api/webservice/guide/api/district
+    :param adcode: 行政图adcode
+    :param subdistrict: 设置显示下级行政区级数（行政区级别包括：国家、省/直辖市、市、区/县、乡镇/街道多级数据）
+    :param extensions: base:不返回行政区边界坐标点；all:只返回当前查询 district 的边界值
+    :return: 行政区的json，读取文件时返回的是缓存的对象，不能修改
+    """
+    fp = district_path(adcode, subdistrict, extensions)
+    # 本地没有时先从离线数据包中取出，最后才访问高德的接口
+    if fp.exists() or extract_member(settings.DISTRICT_BUNDLE, fp.name, DISTRICTS_DIR):
+        return district_cache.get(fp, lambda path: json.loads(path.read_text()))
+    resp = httpx.get(settings.API_BASE_URL, params=district_params(adcode, subdistrict, extensions))
+    district = parse_district_response(resp)
+    fp.write_text(json.dumps(district))
+    return district
+
+
+def district_path(adcode, subdistrict=1, extensions="all"):
+    return DISTRICTS_DIR / f"{adcode}_{subdistrict}_{extensions}.json"
+
+
+def district_params(adcode, subdistrict=1, extensions="all"):
+    return {
         "key": settings.KEY,
         "keywords": adcode,
         "subdistrict": subdistrict,
         "extensions": extensions
-    })
+    }
+
+
+def parse_district_response(resp):
+    """
+    :param resp: 高德行政区查询接口的响应
+    :return: 查询到的行政区
+    """
     if resp.status_code != 200:
         raise ValueError(resp)
     data = resp.json()
-    if data["status"] == 0:
+    # 高德返回的 status 是字符串
+    if str(data["status"]) == "0":
         raise ValueError(data)
-    district = data["districts"][0]
-    fp.write_text(json.dumps(district))
-    return district
+    return data["districts"][0]
+
+
+def province_adcode(adcode) -> str:
+    """
+    adcode前两位即为省级行政区
+    :param adcode: 任意级别的adcode
+    :return: 所属省级行政区的adcode
+    """
+    return f"{str(adcode)[:2]}0000"
+
+
+def aggregate_destination_counts(rows):
+    """
+    将按 (城市adcode, 学校) 分组的统计结果汇总
+    :param rows: 形如 {"city__adcode": ..., "school_id": ..., "count": ...} 的可迭代对象
+    :return: {"cities": {adcode: count}, "schools": {school_id: count}, "provinces": {adcode: count}}
+    """
+    cities, schools, provinces = {}, {}, {}
+    for row in rows:
+        adcode, school, count = row["city__adcode"], row["school_id"], row["count"]
+        if school is not None:
+            schools[school] = schools.get(school, 0) + count
+        if adcode is None:
+            continue
+        cities[adcode] = cities.get(adcode, 0) + count
+        province = province_adcode(adcode)
+        provinces[province] = provinces.get(province, 0) + count
+    return {
+        "cities": cities,
+        "schools": schools,
+        "provinces": provinces,
+    }
 
 
 def string_to_point(s: str):
@@ -52,22 +133,106 @@ def string_to_point(s: str):
     return float(p[0]), float(p[1])
 
 
-def polyline_to_multipolygon(polyline: str):
-    ret = {
+_POLYLINE_SEPARATORS = str.maketrans(";|", ",,")
+
+
+def parse_polyline(polyline: str):
+    """
+    一次性将整条 polyline 转为坐标数组，不逐个点调用 float
+    :param polyline: lon,lat;lon,lat|lon,lat;...
+    :return: 每个环的 (n, 2) 坐标数组
+    """
+    sizes = [polygon.count(";") + 1 for polygon in polyline.split("|")]
+    values = np.fromstring(polyline.translate(_POLYLINE_SEPARATORS), dtype=np.float64, sep=",")
+    if values.size != 2 * sum(sizes):
+        raise ValueError(f"无法解析的polyline：{polyline[:64]}...")
+    return np.split(values.reshape(-1, 2), np.cumsum(sizes[:-1]))
+
+
+def simplify_ring(ring, tolerance):
+    """
+    Douglas-Peucker 简化，每次迭代用向量运算求整段的最远点
+    :param ring: (n, 2) 坐标数组
+    :param tolerance: 容差（度），为 None 时不简化
+    :return: 简化后的坐标数组
+    """
+    n = len(ring)
+    if tolerance is None or n <= 4:
+        return ring
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = ring[start], ring[end]
+        segment = ring[start + 1:end] - a
+        dx, dy = b - a
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            # 闭合环的首尾重合，退化为到点的距离
+            distances = np.hypot(segment[:, 0], segment[:, 1])
+        else:
+            distances = np.abs(dx * segment[:, 1] - dy * segment[:, 0]) / norm
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            i += start + 1
+            keep[i] = True
+            stack.append((start, i))
+            stack.append((i, end))
+    return ring[keep]
+
+
+def quantize_ring(ring, digits):
+    """
+    将坐标保留 digits 位小数，并去掉因此重复的相邻点
+    """
+    if digits is None:
+        return ring
+    ring = np.round(ring, digits)
+    duplicated = np.zeros(len(ring), dtype=bool)
+    duplicated[1:] = (ring[1:] == ring[:-1]).all(axis=1)
+    return ring[~duplicated]
+
+
+def simplify_rings(rings, detail=None):
+    """
+    按细节等级简化一个行政区的所有环，简化后退化的小岛会被丢弃，但至少保留最大的环
+    :param rings: parse_polyline 的结果
+    :param detail: settings.MAP_DETAILS 中的等级，为 None 时不简化
+    :return: 简化后的环
+    """
+    level = settings.MAP_DETAILS[detail] if detail is not None else None
+    if level is None or (level["tolerance"] is None and level["digits"] is None):
+        return rings
+    simplified = [quantize_ring(simplify_ring(ring, level["tolerance"]), level["digits"]) for ring in rings]
+    ret = [ring for ring in simplified if len(ring) >= 4]
+    if not ret and simplified:
+        ret = [max(simplified, key=len)]
+    return ret
+
+
+def polyline_to_multipolygon(polyline: str, detail=None):
+    return {
         "type": "MultiPolygon",
-        "coordinates": []
+        "coordinates": [[ring.tolist()] for ring in simplify_rings(parse_polyline(polyline), detail)]
     }
-    polygons = polyline.split("|")
-    for polygon in polygons:
-        points = polygon.split(";")
-        ret["coordinates"].append([[string_to_point(x) for x in points]])
-    return ret
 
 
-def district_to_feature(district):
-    if 'polyline' in district:
+def district_to_feature(district, detail=None):
+    """
+    :param district: 高德的地区数据格式
+    :param detail: 边界的细节等级，为 None 时使用原始边界
+    :return: Feature
+    """
+    store = get_store(detail)
+    if ('rings' in district or 'polyline' in district) and store is not None and district["adcode"] in store:
+        # 预编译的边界数据
+        geometry = store.multipolygon(district["adcode"])
+    elif 'polyline' in district:
         # 如果有边界信息则标记为边界
-        geometry = polyline_to_multipolygon(district["polyline"])
+        geometry = polyline_to_multipolygon(district["polyline"], detail)
     else:
         geometry = {
             "type": "Point",
@@ -98,11 +263,30 @@ def district_to_point(district):
     }
 
 
-def district_to_feature_collection(district, children=False):
+def iter_compile_districts():
+    """
+    遍历需要编译的行政区：国家、省级行政区及其下属城市
+    :return: (带 polyline 的 district, 下级行政区列表或 None)
+    """
+    country = fetch_district(100000)
+    yield country, country["districts"]
+    for province in country["districts"]:
+        if province["adcode"] in SPECIAL_ADCODES:
+            # 直辖市和特别行政区的下级是区县，不需要记录
+            yield fetch_district(province["adcode"], 0), None
+            continue
+        province = fetch_district(province["adcode"])
+        yield province, province["districts"]
+        for city in province["districts"]:
+            yield fetch_district(city["adcode"], 0), None
+
+
+def district_to_feature_collection(district, children=False, detail=None):
     """
     将高德的district转化为geojson
     :param district: 高德district
     :param children: 是否包含下属地区
+    :param detail: 边界的细节等级
     :return: FeatureCollection
     """
     ret = {
@@ -110,9 +294,137 @@ def district_to_feature_collection(district, children=False):
         "features": []
     }
     # 向FeatureCollection中加入父节点
-    ret["features"].append(district_to_feature(district))
+    ret["features"].append(district_to_feature(district, detail))
     if children:
         for child in district["districts"]:
-            ret["features"].append(district_to_feature(child))
+            ret["features"].append(district_to_feature(child, detail))
 
     return ret
+
+
+def _close_ring(ring):
+    if len(ring) and not (ring[0] == ring[-1]).all():
+        ring = np.vstack([ring, ring[:1]])
+    return ring
+
+
+def _find_junctions(rings, quantization):
+    """
+    公共边界上的点在各个环中的相邻点相同，相邻点不同的点即为交汇点
+    :param rings: 已量化并闭合的整数坐标环
+    :return: 交汇点的编码集合
+    """
+    points, neighbours = [], []
+    for ring in rings:
+        if len(ring) < 3:
+            continue
+        keys = ring[:-1, 0] * quantization + ring[:-1, 1]
+        prev, next_ = np.roll(keys, 1), np.roll(keys, -1)
+        points.append(keys)
+        neighbours.append(np.stack([np.minimum(prev, next_), np.maximum(prev, next_)], axis=1))
+    if not points:
+        return set()
+    triples = np.unique(np.column_stack([np.concatenate(points), np.concatenate(neighbours)]), axis=0)
+    keys, counts = np.unique(triples[:, 0], return_counts=True)
+    return set(keys[counts > 1].tolist())
+
+
+def features_to_topology(features, quantization=1e5, name="districts"):
+    """
+    将 GeoJSON Feature 编码为 TopoJSON：公共边界只保存一次，坐标量化为整数并做差分编码
+    https://github.com/topojson/topojson-specification
+    :param features: district_to_feature 的结果
+    :param quantization: 每个方向上的量化级数
+    :param name: objects 中的名字
+    :return: Topology
+    """
+    quantization = int(quantization)
+    coordinates = [
+        np.asarray(ring, dtype=np.float64)
+        for feature in features if feature["geometry"]["type"] == "MultiPolygon"
+        for polygon in feature["geometry"]["coordinates"] for ring in polygon
+    ] + [
+        np.asarray([feature["geometry"]["coordinates"]], dtype=np.float64)
+        for feature in features if feature["geometry"]["type"] == "Point"
+    ]
+    all_points = np.concatenate(coordinates) if coordinates else np.zeros((1, 2))
+    translate = all_points.min(axis=0)
+    scale = (all_points.max(axis=0) - translate) / (quantization - 1)
+    scale[scale == 0] = 1
+
+    def quantize(points):
+        return np.round((np.asarray(points, dtype=np.float64) - translate) / scale).astype(np.int64)
+
+    def quantize_ring(ring):
+        # 量化、去掉重复的相邻点并闭合
+        q = quantize(ring)
+        duplicated = np.zeros(len(q), dtype=bool)
+        duplicated[1:] = (q[1:] == q[:-1]).all(axis=1)
+        return _close_ring(q[~duplicated])
+
+    quantized = [
+        [[quantize_ring(ring) for ring in polygon] for polygon in feature["geometry"]["coordinates"]]
+        if feature["geometry"]["type"] == "MultiPolygon" else None
+        for feature in features
+    ]
+    junctions = _find_junctions(
+        [ring for polygons in quantized if polygons is not None for polygon in polygons for ring in polygon],
+        quantization
+    )
+
+    arcs, arc_index = [], {}
+
+    def add_arc(points):
+        key = tuple(points.ravel().tolist())
+        if key in arc_index:
+            return arc_index[key]
+        reversed_key = tuple(points[::-1].ravel().tolist())
+        if reversed_key in arc_index:
+            return ~arc_index[reversed_key]
+        arc_index[key] = len(arcs)
+        arcs.append(points)
+        return arc_index[key]
+
+    def ring_to_arcs(ring):
+        if len(ring) < 4:
+            return [add_arc(ring)]
+        keys = (ring[:-1, 0] * quantization + ring[:-1, 1]).tolist()
+        cuts = [i for i, key in enumerate(keys) if key in junctions]
+        if not cuts:
+            # 没有交汇点的环（如岛屿）从最小的点开始，这样相同的环只保存一次
+            cuts = [int(np.argmin(keys))]
+        body = np.vstack([ring[cuts[0]:-1], ring[:cuts[0]], ring[cuts[0]:cuts[0] + 1]])
+        offsets = [cut - cuts[0] for cut in cuts] + [len(body) - 1]
+        return [add_arc(body[start:end + 1]) for start, end in zip(offsets, offsets[1:])]
+
+    geometries = []
+    for feature, polygons in zip(features, quantized):
+        geometry = feature["geometry"]
+        if polygons is not None:
+            topo_geometry = {
+                "type": "MultiPolygon",
+                "arcs": [[ring_to_arcs(ring) for ring in polygon] for polygon in polygons],
+            }
+        else:
+            topo_geometry = {
+                "type": "Point",
+                "coordinates": quantize(geometry["coordinates"]).tolist(),
+            }
+        topo_geometry["properties"] = feature["properties"]
+        geometries.append(topo_geometry)
+
+    return {
+        "type": "Topology",
+        "transform": {
+            "scale": scale.tolist(),
+            "translate": translate.tolist(),
+        },
+        "objects": {
+            name: {
+                "type": "GeometryCollection",
+                "geometries": geometries,
+            }
+        },
+        # 差分编码：第一个点为绝对坐标，之后为与前一个点的差
+        "arcs": [np.vstack([arc[:1], np.diff(arc, axis=0)]).tolist() for arc in arcs],
+    }
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+逆地理编码：由经纬度找到所在的城市
+
+城市边界的每个环按外接矩形登记到规则网格中，查询时只取出点所在格子里的环，
+先用外接矩形过滤，再用射线法（向量化）判断点是否在环内。
+一个城市的所有环按奇偶规则合并，落在奇数个环内即在城市内，洞也能正确处理。
+"""
+import math
+
+import numpy as np
+
+from destination.conf import settings
+from destination.utils.geo import SPECIAL_ADCODES, get_district, parse_polyline, simplify_rings
+from destination.utils.maps import iter_map_districts
+from destination.utils.store import get_store
+
+
+def _district_rings(adcode, detail):
+    store = get_store(detail)
+    if store is not None and adcode in store:
+        return store.ring_arrays(adcode)
+    return simplify_rings(parse_polyline(get_district(adcode, 0)["polyline"]), detail)
+
+
+def ring_contains(ring, lon, lat):
+    """
+    射线法判断点是否在环内，环的首尾是否相同都可以
+    """
+    xs, ys = ring[:, 0], ring[:, 1]
+    xj, yj = np.roll(xs, 1), np.roll(ys, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((ys > lat) != (yj > lat)) & (lon < (xj - xs) * (lat - ys) / (yj - ys) + xs)
+    return np.count_nonzero(crosses) % 2 == 1
+
+
+class CityIndex:
+    def __init__(self, cities, detail=None, cell_size=0.5):
+        """
+        :param cities: 城市（以及直辖市、特别行政区）的 adcode
+        :param detail: 边界的细节等级
+        :param cell_size: 网格的边长（度）
+        """
+        self.cell_size = cell_size
+        self.adcodes = []
+        self.rings, owners, bboxes = [], [], []
+        for adcode in cities:
+            for ring in _district_rings(adcode, detail):
+                if len(ring) < 3:
+                    continue
+                self.rings.append(ring)
+                owners.append(len(self.adcodes))
+                bboxes.append((*ring.min(axis=0), *ring.max(axis=0)))
+            self.adcodes.append(adcode)
+        self.owners = np.asarray(owners, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+
+        grid = {}
+        for ring_id, (min_lon, min_lat, max_lon, max_lat) in enumerate(self.bboxes):
+            for x in range(self._cell(min_lon), self._cell(max_lon) + 1):
+                for y in range(self._cell(min_lat), self._cell(max_lat) + 1):
+                    grid.setdefault((x, y), []).append(ring_id)
+        self.grid = {cell: np.asarray(ring_ids, dtype=np.int64) for cell, ring_ids in grid.items()}
+
+    def _cell(self, value):
+        return math.floor(value / self.cell_size)
+
+    def locate(self, lon, lat):
+        """
+        :return: 点所在城市的 adcode，不在任何城市内时返回 None
+        """
+        candidates = self.grid.get((self._cell(lon), self._cell(lat)))
+        if candidates is None:
+            return None
+        bboxes = self.bboxes[candidates]
+        candidates = candidates[
+            (bboxes[:, 0] <= lon) & (lon <= bboxes[:, 2]) & (bboxes[:, 1] <= lat) & (lat <= bboxes[:, 3])
+        ]
+        parity = {}
+        for ring_id in candidates.tolist():
+            if ring_contains(self.rings[ring_id], lon, lat):
+                owner = int(self.owners[ring_id])
+                parity[owner] = not parity.get(owner, False)
+        for owner, inside in parity.items():
+            if inside:
+                return self.adcodes[owner]
+        return None
+
+
+def iter_city_adcodes():
+    """
+    :return: 地图上的城市，直辖市和特别行政区整体作为一个城市
+    """
+    for district, _, cities in iter_map_districts():
+        if district["adcode"] in SPECIAL_ADCODES:
+            yield district["adcode"]
+        for city in cities:
+            yield city["adcode"]
+
+
+_indexes = {}
+
+
+def get_city_index():
+    """
+    :return: 当前进程的 CityIndex，边界数据重新编译后自动重建
+    """
+    detail = settings.GEOCODE_DETAIL
+    store = get_store(detail)
+    key = (detail, store.version if store is not None else None)
+    if key not in _indexes:
+        _indexes.clear()
+        _indexes[key] = CityIndex(iter_city_adcodes(), detail)
+    return _indexes[key]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务
+
+同一个 key 同时只会有一个任务：提交时通过 cache.add 原子地抢占，抢到的请求才真正提交，
+其余请求只读取状态。任务执行器由 settings.JOB_RUNNER 指定。
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from destination.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class ThreadRunner:
+    """
+    进程内的任务队列，由后台线程池执行
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS, thread_name_prefix="job")
+
+    def submit(self, func, *args):
+        self.executor.submit(self._run, func, *args)
+
+    @staticmethod
+    def _run(func, *args):
+        try:
+            func(*args)
+        finally:
+            # 后台线程有自己的数据库连接，用完需要关闭
+            connection.close()
+
+
+class LocalRunner:
+    """
+    在当前线程中立即执行，用于测试
+    """
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+_runner = None
+
+
+def get_runner():
+    global _runner
+    if _runner is None:
+        _runner = import_string(settings.JOB_RUNNER)()
+    return _runner
+
+
+def _lock_key(key):
+    return f"JOB_{key}_LOCK"
+
+
+def _status_key(key):
+    return f"JOB_{key}_STATUS"
+
+
+def _execute(key, func, *args):
+    cache.set(_status_key(key), RUNNING, settings.JOB_TIMEOUT)
+    try:
+        func(*args)
+    except Exception:
+        logger.exception("任务 %s 执行失败", key)
+        cache.set(_status_key(key), FAILED, settings.JOB_TIMEOUT)
+    else:
+        cache.set(_status_key(key), DONE, settings.JOB_TIMEOUT)
+    finally:
+        cache.delete(_lock_key(key))
+
+
+def submit(key, func, *args):
+    """
+    :param key: 任务的唯一标识，相同 key 的任务不会同时执行
+    :param func: 可以被 import 的函数，参数需要可序列化
+    :return: 是否提交了新的任务
+    """
+    # 锁带有过期时间，进程崩溃时不会卡住
+    if not cache.add(_lock_key(key), PENDING, settings.JOB_TIMEOUT):
+        return False
+    cache.set(_status_key(key), PENDING, settings.JOB_TIMEOUT)
+    get_runner().submit(_execute, key, func, *args)
+    return True
+
+
+def get_status(key):
+    """
+    :return: PENDING, RUNNING, DONE, FAILED 或 None（没有任务）
+    """
+    return cache.get(_status_key(key))
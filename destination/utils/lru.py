@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+按文件缓存解析结果的 LRU 缓存
+
+以文件大小估计解析结果占用的内存，总大小超过上限时淘汰最久没有使用的条目；
+文件的修改时间或大小变化后，缓存的结果失效并重新读取。
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+class FileCache:
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: 缓存的文件总大小上限
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, load):
+        """
+        :param path: 文件路径
+        :param load: 读取并解析文件的函数，参数为 path
+        :return: 解析结果，多次调用返回同一个对象，调用者不能修改
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = load(path)
+        with self._lock:
+            self._remove(path)
+            if stat.st_size <= self.max_bytes:
+                self._entries[path] = (version, value)
+                self.bytes += stat.st_size
+                while self.bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        return value
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.bytes -= entry[0][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        :return: 命中、未命中、淘汰次数，条目数和总大小
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+            }
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+去向统计地图
+
+地图分为两部分：
+    底图：全国省级边界，与班级无关，内容不变时文件名（内容哈希）不变，可以长期缓存
+    叠加层：班级的 {adcode: 人数} 和城市点，只有几KB
+"""
+import json
+from collections.abc import Iterator
+
+from destination.conf import settings
+from destination.utils.geo import SPECIAL_ADCODES, district_to_feature, district_to_point, features_to_topology, \
+    get_district
+from destination.utils.storage import find_asset, get_asset
+from destination.utils.store import get_store
+
+# 地图格式及其文件扩展名
+MAP_FORMATS = {
+    "geojson": "json",
+    "topojson": "topojson",
+}
+
+
+def iter_map_districts():
+    """
+    :return: (省级行政区, 用于绘制轮廓的行政区, 下属城市列表)，直辖市和特别行政区没有下属城市
+    """
+    country = get_district(100000)
+    for district in country["districts"]:
+        if district["adcode"] in SPECIAL_ADCODES:
+            yield district, get_district(district["adcode"], 0), []
+        else:
+            province = get_district(district["adcode"])
+            yield district, province, province["districts"]
+
+
+def iter_base_features(detail=None):
+    """
+    逐个读取省级边界，不需要同时持有所有边界
+    """
+    for _, outline, _ in iter_map_districts():
+        yield district_to_feature(outline, detail)
+
+
+def build_base_map(detail=None):
+    """
+    :param detail: 边界的细节等级
+    :return: 不带统计数据的全国省级边界 FeatureCollection
+    """
+    return {
+        "type": "FeatureCollection",
+        "features": list(iter_base_features(detail))
+    }
+
+
+def encode_feature_collection(collection, detail=None, fmt="geojson"):
+    """
+    :param collection: FeatureCollection
+    :param detail: 边界的细节等级，决定 TopoJSON 的量化级数
+    :param fmt: MAP_FORMATS 中的格式
+    :return: 对应格式的地图
+    """
+    if fmt == "topojson":
+        level = settings.MAP_DETAILS[detail or settings.MAP_FULL_DETAIL]
+        return features_to_topology(collection["features"], level["quantization"])
+    return collection
+
+
+def get_map_points(counts, districts=None):
+    """
+    echarts 的点需要单独给出，直辖市和特别行政区用省级中心点，其余用城市中心点
+    :param counts: aggregate_destination_counts 的结果
+    :param districts: 预先读取的 iter_map_districts 结果
+    :return: 有学生的点
+    """
+    city_counts, province_counts = counts["cities"], counts["provinces"]
+    points = []
+    for district, _, cities in districts if districts is not None else iter_map_districts():
+        if district["adcode"] in SPECIAL_ADCODES:
+            count = province_counts.get(district["adcode"], 0)
+            if count > 0:
+                point = district_to_point(district)
+                point["province"] = district["name"]
+                point["count"] = count
+                points.append(point)
+        for city in cities:
+            count = city_counts.get(city["adcode"], 0)
+            if count > 0:
+                point = district_to_point(city)
+                point["count"] = count
+                point["province"] = district["name"]
+                points.append(point)
+    return points
+
+
+def get_map_overlay(counts):
+    """
+    :param counts: aggregate_destination_counts 的结果
+    :return: 叠加在底图上的 {adcode: 人数} 和城市点
+    """
+    return {
+        "counts": {**counts["cities"], **counts["provinces"]},
+        "points": get_map_points(counts),
+    }
+
+
+def prepare_class_maps(detail=None, fmt="geojson"):
+    """
+    批量生成地图时，边界和行政区只读取、编码一次
+    :return: 供 build_class_map 使用的底图和行政区
+    """
+    return {
+        "base": encode_feature_collection(build_base_map(detail), detail, fmt),
+        "districts": [(district, None, cities) for district, _, cities in iter_map_districts()],
+    }
+
+
+def _with_count(item, province_counts):
+    """
+    :return: 只复制 properties，边界数据与 item 共用
+    """
+    return {**item, "properties": {**item["properties"], "count": province_counts.get(item["properties"]["adcode"], 0)}}
+
+
+def _with_counts(base, province_counts, fmt):
+    if fmt == "topojson":
+        (name, collection), = base["objects"].items()
+        items = collection["geometries"]
+    else:
+        items = base["features"]
+    items = [_with_count(item, province_counts) for item in items]
+    if fmt == "topojson":
+        return {**base, "objects": {name: {**collection, "geometries": items}}}
+    return {**base, "features": items}
+
+
+def build_class_map(counts, detail=None, fmt="geojson", prepared=None):
+    """
+    底图和叠加层合并后的完整地图，省级人数写在 properties 中
+    :param prepared: prepare_class_maps 的结果，为 None 时重新读取
+    """
+    if prepared is None:
+        prepared = prepare_class_maps(detail, fmt)
+    return {
+        "map": _with_counts(prepared["base"], counts["provinces"], fmt),
+        "points": get_map_points(counts, prepared["districts"]),
+    }
+
+
+def iter_json(value, depth):
+    """
+    逐块编码 JSON，结果与 json.dumps(value) 相同
+    :param value: 键都是字符串的 dict，list 或迭代器（编码为数组）
+    :param depth: 展开的层数，更深的值整体交给 json.dumps
+    :return: 可迭代的 str
+    """
+    if depth <= 0 or not isinstance(value, (dict, list, tuple, Iterator)):
+        yield json.dumps(value)
+    elif isinstance(value, dict):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            yield f"{', ' if i else ''}{json.dumps(key)}: "
+            yield from iter_json(item, depth - 1)
+        yield "}"
+    else:
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ", "
+            yield from iter_json(item, depth - 1)
+        yield "]"
+
+
+def iter_class_map(counts, detail=None, fmt="geojson", prepared=None):
+    """
+    逐个要素编码地图文件，结果与 json.dumps(build_class_map(...)) 相同
+    没有 prepared 时 GeoJSON 的边界也逐个读取，内存占用与地图大小无关；
+    TopoJSON 需要全部边界才能找出公共边，只能整体编码后逐条写出
+    :return: 可迭代的 str
+    """
+    if prepared is not None or fmt == "topojson":
+        return iter_json(build_class_map(counts, detail, fmt, prepared), 3)
+
+    districts = []
+
+    def features():
+        for district, outline, cities in iter_map_districts():
+            districts.append((district, None, cities))
+            yield _with_count(district_to_feature(outline, detail), counts["provinces"])
+
+    def points():
+        # 在所有边界写出后才会执行，此时 districts 已经读取完毕
+        yield from get_map_points(counts, districts)
+
+    return iter_json({"map": {"type": "FeatureCollection", "features": features()}, "points": points()}, 3)
+
+
+def _store_version(detail):
+    store = get_store(detail)
+    return store.version if store is not None else "raw"
+
+
+def base_map_name(detail, digest, fmt="geojson"):
+    return f"map/base/{detail}.{digest}.{MAP_FORMATS[fmt]}"
+
+
+def base_map_cache_key(detail, fmt="geojson"):
+    """
+    也是后台生成底图的任务的 key，见 destination.utils.jobs
+    """
+    return f"BASE_MAP_{detail}_{fmt}_{_store_version(detail)}"
+
+
+def find_base_map_asset(detail, fmt="geojson"):
+    """
+    :return: 已生成的底图的 (内容哈希, 文件名)，尚未生成时返回 None
+    """
+    return find_asset(base_map_cache_key(detail, fmt), base_map_name(detail, "{digest}", fmt))
+
+
+def get_base_map_asset(detail, fmt="geojson"):
+    """
+    没有时立即生成，只在后台任务和 build_maps 中调用
+    :return: 底图的 (内容哈希, 文件名)
+    """
+    def build():
+        if fmt == "topojson":
+            return iter_json(encode_feature_collection(build_base_map(detail), detail, fmt), 2)
+        return iter_json({"type": "FeatureCollection", "features": iter_base_features(detail)}, 2)
+
+    return get_asset(base_map_cache_key(detail, fmt), base_map_name(detail, "{digest}", fmt), build)
+
+
+def is_leaf_adcode(adcode):
+    """
+    城市、直辖市和特别行政区在地图上不再下钻
+    """
+    adcode = str(adcode)
+    return adcode in SPECIAL_ADCODES or not adcode.endswith("0000")
+
+
+def _get_outline(adcode):
+    """
+    与 iter_map_districts 读取相同的数据：省级行政区带有下属城市，其余不需要下级
+    """
+    return get_district(adcode, 0 if is_leaf_adcode(adcode) else 1)
+
+
+def get_district_children(adcode):
+    """
+    :return: 地图上行政区的直接下级（省级行政区或城市），不能下钻时为空列表，不在地图上时返回 None
+    """
+    adcode = str(adcode)
+    if adcode == "100000":
+        return get_district(100000)["districts"]
+    for district, _, cities in iter_map_districts():
+        if district["adcode"] == adcode:
+            return cities
+        if any(city["adcode"] == adcode for city in cities):
+            return []
+    return None
+
+
+def iter_district_features(adcode, detail=None):
+    """
+    行政区本身的边界在前，之后是直接下级的边界，逐个读取
+    """
+    district = _get_outline(adcode)
+    yield district_to_feature(district, detail)
+    if not is_leaf_adcode(adcode):
+        for child in district["districts"]:
+            yield district_to_feature(_get_outline(child["adcode"]), detail)
+
+
+def district_map_name(adcode, detail, digest, fmt="geojson"):
+    return f"map/districts/{adcode}/{detail}.{digest}.{MAP_FORMATS[fmt]}"
+
+
+def district_map_cache_key(adcode, detail, fmt="geojson"):
+    """
+    也是后台生成行政区地图的任务的 key，见 destination.utils.jobs
+    """
+    return f"DISTRICT_MAP_{adcode}_{detail}_{fmt}_{_store_version(detail)}"
+
+
+def find_district_map_asset(adcode, detail, fmt="geojson"):
+    """
+    :return: 已生成的行政区地图的 (内容哈希, 文件名)，尚未生成时返回 None
+    """
+    return find_asset(district_map_cache_key(adcode, detail, fmt), district_map_name(adcode, detail, "{digest}", fmt))
+
+
+def get_district_map_asset(adcode, detail, fmt="geojson"):
+    """
+    下钻时使用的单个行政区及其直接下级的边界，与班级无关，每个 adcode 一个文件
+    没有时立即生成，只在后台任务和 build_maps 中调用
+    :return: (内容哈希, 文件名)
+    """
+    def build():
+        features = iter_district_features(adcode, detail)
+        if fmt == "topojson":
+            collection = {"type": "FeatureCollection", "features": list(features)}
+            return iter_json(encode_feature_collection(collection, detail, fmt), 2)
+        return iter_json({"type": "FeatureCollection", "features": features}, 2)
+
+    return get_asset(
+        district_map_cache_key(adcode, detail, fmt),
+        district_map_name(adcode, detail, "{digest}", fmt),
+        build
+    )
+
+
+def build_map_assets(details, formats=("geojson",), districts=False):
+    """
+    预先生成底图，接口只读取已生成的文件
+    :param districts: 同时生成所有可以下钻的行政区的地图
+    :return: 文件数（包括已经存在的）
+    """
+    adcodes = []
+    if districts:
+        adcodes.append("100000")
+        for district, _, cities in iter_map_districts():
+            adcodes.append(district["adcode"])
+            adcodes.extend(city["adcode"] for city in cities)
+    for detail in details:
+        for fmt in formats:
+            get_base_map_asset(detail, fmt)
+            for adcode in adcodes:
+                get_district_map_asset(adcode, detail, fmt)
+    return len(details) * len(formats) * (1 + len(adcodes))
+
+
+def get_district_overlay(counts, adcode, children):
+    """
+    :param counts: aggregate_destination_counts 的结果
+    :param children: get_district_children 的结果
+    :return: 行政区的人数和直接下级的 {adcode: 人数}
+    """
+    adcode = str(adcode)
+    if adcode == "100000":
+        count = sum(counts["provinces"].values())
+    elif adcode.endswith("0000"):
+        count = counts["provinces"].get(adcode, 0)
+    else:
+        count = counts["cities"].get(adcode, 0)
+    level = counts["provinces"] if adcode == "100000" else counts["cities"]
+    return {
+        "adcode": adcode,
+        "count": count,
+        "children": {child["adcode"]: level.get(child["adcode"], 0) for child in children},
+    }
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+并发预取行政区数据
+
+按层级并发请求：国家 -> 省级行政区 -> 城市，同一层的请求同时发出，并发数由信号量限制。
+预取的行政区与 iter_compile_districts 和生成地图时读取的相同，预取后请求中不再访问高德的接口。
+"""
+import asyncio
+import json
+
+import httpx
+
+from destination.conf import settings
+from destination.utils.geo import SPECIAL_ADCODES, district_params, district_path, parse_district_response
+
+
+async def _fetch(client, semaphore, adcode, subdistrict, stats):
+    fp = district_path(adcode, subdistrict)
+    if fp.exists():
+        stats["cached"] += 1
+        return json.loads(fp.read_text())
+    async with semaphore:
+        resp = await client.get(settings.API_BASE_URL, params=district_params(adcode, subdistrict))
+    district = parse_district_response(resp)
+    fp.write_text(json.dumps(district))
+    stats["fetched"] += 1
+    return district
+
+
+async def _prefetch(concurrency):
+    stats = {"fetched": 0, "cached": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        def fetch(adcode, subdistrict=1):
+            return _fetch(client, semaphore, adcode, subdistrict, stats)
+
+        country = await fetch(100000)
+        provinces = await asyncio.gather(*[
+            fetch(province["adcode"], 0 if province["adcode"] in SPECIAL_ADCODES else 1)
+            for province in country["districts"]
+        ])
+        await asyncio.gather(*[
+            fetch(city["adcode"], 0)
+            for province in provinces if province["adcode"] not in SPECIAL_ADCODES
+            for city in province["districts"]
+        ])
+    return stats
+
+
+def prefetch_districts(concurrency=None):
+    """
+    :param concurrency: 最大并发请求数，默认为 settings.PREFETCH_CONCURRENCY
+    :return: {"fetched": 请求的行政区数, "cached": 本地已有的行政区数}
+    """
+    return asyncio.run(_prefetch(concurrency or settings.PREFETCH_CONCURRENCY))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+城市和学校的进程内缓存
+
+两张表几乎不变，每个进程保存一份完整的数据，按名字、id、adcode 建立索引。
+数据变化时（导入数据、模型的 post_save/post_delete）更新缓存中的版本号，
+各进程在下次读取时发现版本号不同，重新加载。版本号是随机的字符串，
+缓存被清空后也不会与以前的版本号相同，可以直接作为 ETag。
+生产环境的缓存在数据库中，版本号在进程内保留 REFERENCE_VERSION_TTL 秒，不必每个请求都查询。
+
+省 -> 城市 -> 学校数的层级由 adcode 的前两位得到，整体作为一个按内容哈希命名的文件发送，
+选择器一次就能拿到所有城市，某个城市的学校再通过 /schools/?city= 按需加载。
+"""
+import json
+import secrets
+import time
+
+from django.core.cache import cache
+
+from destination.conf import settings
+from destination.models import City, School
+from destination.utils.geo import get_district, province_adcode
+from destination.utils.storage import get_asset
+
+VERSION_CACHE_KEY = "REFERENCE_VERSION"
+
+# (版本号, 读取时间)
+_version = None
+
+
+def get_version():
+    """
+    :return: 当前的版本号，缓存中没有时生成一个
+    """
+    global _version
+    now = time.monotonic()
+    if _version is None or now - _version[1] >= settings.REFERENCE_VERSION_TTL:
+        _version = cache.get_or_set(VERSION_CACHE_KEY, lambda: secrets.token_hex(8), None), now
+    return _version[0]
+
+
+def bump_version():
+    """
+    城市或学校变化后调用，当前进程立即重新加载，其他进程最多在 REFERENCE_VERSION_TTL 秒后重新加载
+    """
+    global _version
+    _version = secrets.token_hex(8), time.monotonic()
+    cache.set(VERSION_CACHE_KEY, _version[0], None)
+
+
+class ReferenceData:
+    def __init__(self, version):
+        self.version = version
+        self.cities = list(City.objects.order_by("pk"))
+        self.city_by_name = {city.name: city for city in self.cities}
+        self.city_by_adcode = {city.adcode: city for city in self.cities}
+        self.schools = list(School.objects.order_by("pk"))
+        self.schools_by_city = {}
+        for school in self.schools:
+            # 使用缓存中的城市，访问 school.city 不再查询数据库
+            school.city = self.city_by_name[school.city_id]
+            self.schools_by_city.setdefault(school.city_id, []).append(school)
+        self.school_by_id = {school.id: school for school in self.schools}
+        self.school_by_name = {school.name: school for school in self.schools}
+
+
+_reference = None
+
+
+def get_reference():
+    """
+    :return: 当前进程的 ReferenceData，版本号变化后自动重新加载
+    """
+    global _reference
+    version = get_version()
+    if _reference is None or _reference.version != version:
+        _reference = ReferenceData(version)
+    return _reference
+
+
+def build_city_tree(reference):
+    """
+    :return: [{"adcode", "name", "schools", "cities": [{"adcode", "name", "schools"}]}]，按 adcode 排序
+    直辖市和特别行政区本身就是城市，没有下属城市
+    """
+    provinces = {
+        district["adcode"]: {"adcode": district["adcode"], "name": district["name"], "schools": 0, "cities": []}
+        for district in get_district(100000)["districts"]
+    }
+    for city in sorted(reference.cities, key=lambda city: city.adcode):
+        count = len(reference.schools_by_city.get(city.name, []))
+        adcode = province_adcode(city.adcode)
+        province = provinces.setdefault(adcode, {
+            "adcode": adcode, "name": city.name if city.adcode == adcode else "", "schools": 0, "cities": []
+        })
+        province["schools"] += count
+        if city.adcode != adcode:
+            province["cities"].append({"adcode": city.adcode, "name": city.name, "schools": count})
+    return [provinces[adcode] for adcode in sorted(provinces)]
+
+
+def city_tree_name(digest):
+    return f"reference/cities.{digest}.json"
+
+
+def get_city_tree_asset():
+    """
+    :return: 城市层级的 (内容哈希, 文件名)，城市和学校变化后重新生成
+    """
+    reference = get_reference()
+
+    def build():
+        yield json.dumps(build_city_tree(reference), ensure_ascii=False, separators=(",", ":"))
+
+    return get_asset(f"CITY_TREE_{reference.version}", city_tree_name("{digest}"), build)
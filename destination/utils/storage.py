@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+按内容哈希命名的文件
+
+内容逐块写入临时文件，同时计算哈希，写完后再原子地移动到最终文件名，
+不需要在内存中拼出完整的文件，读取者也不会看到写了一半的文件。
+每个文件旁边还可以有预先压缩的版本（<name>.gz, <name>.br），由前端服务器直接发送。
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from destination.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 压缩方式及其文件扩展名
+ENCODINGS = {
+    "br": ".br",
+    "gzip": ".gz",
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _local_path(name):
+    """
+    :return: 本地存储中的绝对路径，存储不在本地时返回 None
+    """
+    try:
+        return default_storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def _temp_file(name):
+    """
+    临时文件与目标文件在同一目录下，保证 os.replace 是原子的
+    :return: (文件描述符, 临时文件路径)
+    """
+    path = _local_path(name)
+    directory = os.path.dirname(path) if path is not None else None
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    return tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+
+
+def _publish(tmp_path, name):
+    """
+    将写完的临时文件移动到 name，已经存在时（内容相同）不做任何事
+    """
+    if default_storage.exists(name):
+        return
+    path = _local_path(name)
+    if path is not None:
+        mode = getattr(default_storage, "file_permissions_mode", None)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    else:
+        with open(tmp_path, "rb") as f:
+            default_storage.save(name, File(f))
+
+
+def save_stream(chunks, name):
+    """
+    :param chunks: 可迭代的 str
+    :param name: 文件名模板，其中的 {digest} 会被替换为内容哈希
+    :return: (文件名, 内容哈希, 文件大小)
+    """
+    fd, tmp_path = _temp_file(name)
+    try:
+        sha256, size = hashlib.sha256(), 0
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                data = chunk.encode()
+                sha256.update(data)
+                f.write(data)
+                size += len(data)
+        digest = sha256.hexdigest()[:16]
+        name = name.format(digest=digest)
+        _publish(tmp_path, name)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return name, digest, size
+
+
+def get_encodings():
+    """
+    :return: settings.MAP_ENCODINGS 中当前环境支持的压缩方式，按优先级排列
+    """
+    return [encoding for encoding in settings.MAP_ENCODINGS if encoding != "br" or brotli is not None]
+
+
+def _compress(src, dst, encoding):
+    if encoding == "gzip":
+        # mtime 固定，相同的内容压缩后也相同
+        with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=9, mtime=0) as f:
+            for block in iter(lambda: src.read(CHUNK_SIZE), b""):
+                f.write(block)
+    else:
+        compressor = brotli.Compressor(quality=11)
+        for block in iter(lambda: src.read(CHUNK_SIZE), b""):
+            dst.write(compressor.process(block))
+        dst.write(compressor.finish())
+
+
+def save_compressed(name):
+    """
+    在 name 旁边写入各个压缩版本，逐块压缩，不会一次读入整个文件
+    """
+    for encoding in get_encodings():
+        variant = name + ENCODINGS[encoding]
+        if default_storage.exists(variant):
+            continue
+        fd, tmp_path = _temp_file(variant)
+        try:
+            with default_storage.open(name) as src, os.fdopen(fd, "wb") as dst:
+                _compress(src, dst, encoding)
+            _publish(tmp_path, variant)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def delete_file(name):
+    """
+    删除文件及其压缩版本
+    """
+    for ext in ["", *ENCODINGS.values()]:
+        default_storage.delete(name + ext)
+
+
+def find_asset(cache_key, name):
+    """
+    只读取缓存，不生成文件
+    :param name: 文件名模板，见 save_stream
+    :return: (内容哈希, 文件名)，尚未生成或文件已被删除时返回 None
+    """
+    digest = cache.get(cache_key)
+    if digest is None or not default_storage.exists(name.format(digest=digest)):
+        return None
+    return digest, name.format(digest=digest)
+
+
+def get_asset(cache_key, name, build):
+    """
+    按内容哈希命名的文件只在数据变化后重新生成，各进程通过缓存共享内容哈希
+    :param name: 文件名模板，见 save_stream
+    :param build: 返回文件内容（可迭代的 str）的函数
+    :return: (内容哈希, 文件名)
+    """
+    asset = find_asset(cache_key, name)
+    if asset is None:
+        saved, digest, _ = save_stream(build(), name)
+        save_compressed(saved)
+        cache.set(cache_key, digest, None)
+        asset = digest, name.format(digest=digest)
+    return asset
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+预编译的行政区边界数据
+
+所有边界坐标被编译为一个扁平的 float64 数组，配合环的偏移索引按 adcode 查找。
+数组通过 mmap 加载，多个 worker 进程共享同一份页缓存，而不是各自持有解析后的列表。
+
+每个细节等级（settings.MAP_DETAILS）编译一份，目录结构：
+    <detail>/coords.<version>.npy  (N, 2) float64，所有环的坐标点首尾相接
+    <detail>/rings.<version>.npy   (R + 1,) int64，第 i 个环为 coords[rings[i]:rings[i + 1]]
+    <detail>/index.json            {"version": ..., "coords": ..., "rings": ..., "districts": {adcode: 元数据}}
+重新编译时先写入新版本的数组，最后原子地替换 index.json；
+各进程的 get_store 发现 index.json 被替换后打开新版本，已经 mmap 的旧文件在删除后仍然可用。
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from destination.conf import settings
+
+
+def _district_meta(district):
+    return {
+        "adcode": district["adcode"],
+        "name": district["name"],
+        "level": district["level"],
+        "center": district["center"],
+    }
+
+
+class GeometryStore:
+    def __init__(self, root):
+        self.root = root
+        index = json.loads((root / "index.json").read_text())
+        self.version = index["version"]
+        self.districts = index["districts"]
+        # 没有记录文件名的是旧格式
+        self.coords = np.load(root / index.get("coords", "coords.npy"), mmap_mode="r")
+        self.rings = np.load(root / index.get("rings", "rings.npy"), mmap_mode="r")
+
+    def __contains__(self, adcode):
+        return str(adcode) in self.districts
+
+    def get_district(self, adcode, subdistrict=1):
+        """
+        与 geo.get_district 返回的格式一致，但用 rings 代替 polyline
+        :return: 未编译的行政区或下级层数不够时返回 None
+        """
+        district = self.districts.get(str(adcode))
+        if district is None or subdistrict > 1:
+            return None
+        if subdistrict == 1 and district["districts"] is None:
+            return None
+        return {
+            **district,
+            "districts": (district["districts"] or []) if subdistrict == 1 else [],
+        }
+
+    def ring_arrays(self, adcode):
+        """
+        :return: 行政区每个环的 (n, 2) 坐标数组（mmap 视图，不复制）
+        """
+        start, end = self.districts[str(adcode)]["rings"]
+        offsets = self.rings[start:end + 1]
+        return [self.coords[offsets[i]:offsets[i + 1]] for i in range(end - start)]
+
+    def multipolygon(self, adcode):
+        return {
+            "type": "MultiPolygon",
+            "coordinates": [[ring.tolist()] for ring in self.ring_arrays(adcode)]
+        }
+
+
+class _StoreWriter:
+    def __init__(self):
+        self.coords, self.offsets, self.index = [], [0], {}
+
+    def add(self, district, children, rings):
+        ring_count = len(self.offsets) - 1
+        for ring in rings:
+            self.coords.append(ring)
+            self.offsets.append(self.offsets[-1] + len(ring))
+        self.index[district["adcode"]] = {
+            **_district_meta(district),
+            "rings": [ring_count, ring_count + len(rings)],
+            "districts": None if children is None else [_district_meta(child) for child in children],
+        }
+
+    def save(self, root):
+        root.mkdir(exist_ok=True, parents=True)
+        coords = np.concatenate(self.coords) if self.coords else np.empty((0, 2), dtype=np.float64)
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        digest = hashlib.sha256()
+        digest.update(coords.tobytes())
+        digest.update(json.dumps(self.index, sort_keys=True).encode())
+
+        version = digest.hexdigest()[:16]
+        files = {"coords": f"coords.{version}.npy", "rings": f"rings.{version}.npy"}
+
+        # 同一版本的内容相同，不覆盖其他进程正在 mmap 的文件
+        for key, array in [("coords", coords), ("rings", offsets)]:
+            if not (root / files[key]).exists():
+                _write_atomic(root / files[key], lambda f, array=array: np.save(f, array))
+        index = json.dumps({"version": version, **files, "districts": self.index}, ensure_ascii=False)
+        _write_atomic(root / "index.json", lambda f: f.write(index.encode()))
+        for path in root.glob("*.npy"):
+            if path.name not in files.values():
+                path.unlink()
+        return GeometryStore(root)
+
+
+def _write_atomic(path, write):
+    """
+    写入同一目录下的临时文件后用 os.replace 替换，读取的进程不会看到写了一半的文件
+    :param write: 接收二进制文件对象的函数
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def compile_store(districts, root, details):
+    """
+    将带 polyline 的行政区编译为各个细节等级的 GeometryStore，每个 polyline 只解析一次
+    :param districts: 可迭代的 (district, children) ，children 为 None 表示不记录下级行政区
+    :param root: 输出目录
+    :param details: 需要编译的细节等级
+    :return: {detail: GeometryStore}
+    """
+    from destination.utils.geo import parse_polyline, simplify_rings
+
+    writers = {detail: _StoreWriter() for detail in details}
+    for district, children in districts:
+        rings = parse_polyline(district["polyline"])
+        for detail, writer in writers.items():
+            writer.add(district, children, simplify_rings(rings, detail))
+    return {detail: writer.save(root / detail) for detail, writer in writers.items()}
+
+
+# {detail: (GeometryStore, 打开时 index.json 的 (路径, inode, 修改时间))}
+_stores = {}
+
+
+def get_store(detail=None):
+    """
+    每次调用检查 index.json，重新编译后打开新版本，不需要重启 worker
+    :param detail: 细节等级，为 None 时使用原始边界
+    :return: 当前进程的 GeometryStore，尚未编译时返回 None
+    """
+    detail = detail or settings.MAP_FULL_DETAIL
+    index_path = settings.GEOMETRY_ROOT / detail / "index.json"
+    try:
+        stat = index_path.stat()
+    except FileNotFoundError:
+        _stores.pop(detail, None)
+        return None
+    # GEOMETRY_ROOT 改变时即使 inode 被复用也会重新打开
+    key = index_path, stat.st_ino, stat.st_mtime_ns
+    cached = _stores.get(detail)
+    if cached is None or cached[1] != key:
+        cached = _stores[detail] = GeometryStore(index_path.parent), key
+    return cached[0]
+
+
+def reset_store():
+    _stores.clear()
@@ -1,10 +1,30 @@
-from rest_framework import mixins, viewsets
+import math
+from urllib.parse import quote
+
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.filters import SearchFilter
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
 
+from destination.conf import settings
 from destination.models import City, School
+from destination.renderers import MAP_RENDERER_CLASSES, TopoJSONRenderer, get_map_format
 from destination.serializers import CitySimpleSerializer, SchoolSimpleSerializer
+from destination.utils.autocomplete import get_index
+from destination.utils.geocode import get_city_index
+from destination.utils import jobs
+from destination.utils.maps import MAP_FORMATS, base_map_cache_key, district_map_cache_key, find_base_map_asset, \
+    find_district_map_asset, get_base_map_asset, get_district_children, get_district_map_asset
+from destination.utils.reference import get_city_tree_asset, get_reference
+from destination.utils.storage import ENCODINGS, get_encodings
 
 
 class Pagination(PageNumberPagination):
@@ -12,12 +32,59 @@ class Pagination(PageNumberPagination):
     max_page_size = 50
 
 
+def autocomplete(request, kind):
+    """
+    ?q= 的输入提示，按匹配程度排序，k 为返回的数量
+    """
+    try:
+        k = min(int(request.query_params.get("k", 10)), 50)
+    except ValueError:
+        return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["k 必须是整数"]})
+    return Response(data={"results": get_index(kind).search(request.query_params.get("q", ""), k)})
+
+
+class ReferenceMixin:
+    """
+    列表和详情从 destination.utils.reference 读取，不查询数据库（搜索除外）
+    列表以缓存的版本号作为 ETag，数据没有变化时返回 304
+    """
+    reference_items = None
+    reference_lookup = None
+
+    def get_reference_items(self, reference):
+        return getattr(reference, self.reference_items)
+
+    def get_object(self):
+        obj = getattr(get_reference(), self.reference_lookup).get(self.kwargs[self.lookup_field])
+        if obj is None:
+            raise NotFound()
+        return obj
+
+    def list(self, request, *args, **kwargs):
+        reference = get_reference()
+        etag = f'"{reference.version}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            if any(request.query_params.get(backend.search_param) for backend in self.filter_backends):
+                items = self.filter_queryset(self.get_queryset())
+            else:
+                items = self.get_reference_items(reference)
+            page = self.paginate_queryset(items)
+            response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        response["ETag"] = etag
+        response["Cache-Control"] = "no-cache"
+        return response
+
+
 class SchoolViewSet(
+    ReferenceMixin,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin,
     viewsets.GenericViewSet
 ):
-    queryset = School.objects.all()
+    queryset = School.objects.order_by("pk")
+    reference_items = "schools"
+    reference_lookup = "school_by_id"
     permission_classes = [AllowAny]
     serializer_class = SchoolSimpleSerializer
     lookup_field = 'id'
@@ -25,16 +92,270 @@ class SchoolViewSet(
     search_fields = ["name"]
     pagination_class = Pagination
 
+    def get_city(self):
+        """
+        ?city= 城市名或 adcode，没有该参数时返回 None，城市不存在时返回空字符串
+        """
+        city = self.request.query_params.get("city")
+        if not city:
+            return None
+        reference = get_reference()
+        city = reference.city_by_name.get(city) or reference.city_by_adcode.get(city)
+        return city.name if city is not None else ""
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        city = self.get_city()
+        if city is not None:
+            queryset = queryset.filter(city=city)
+        return queryset
+
+    def get_reference_items(self, reference):
+        city = self.get_city()
+        if city is None:
+            return reference.schools
+        return reference.schools_by_city.get(city, [])
+
+    @action(detail=False, methods=["get"])
+    def autocomplete(self, request, *args, **kwargs):
+        return autocomplete(request, "school")
+
 
 class CityViewSet(
+    ReferenceMixin,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin,
     viewsets.GenericViewSet
 ):
-    queryset = City.objects.all()
+    # 城市的主键是名字
+    queryset = City.objects.order_by("pk")
+    reference_items = "cities"
+    reference_lookup = "city_by_name"
     permission_classes = [AllowAny]
     serializer_class = CitySimpleSerializer
     lookup_field = 'id'
     filter_backends = [SearchFilter]
     search_fields = ["name"]
     pagination_class = Pagination
+
+    @action(detail=False, methods=["get"])
+    def autocomplete(self, request, *args, **kwargs):
+        return autocomplete(request, "city")
+
+    @action(detail=False, methods=["get"])
+    def tree(self, request, *args, **kwargs):
+        """
+        省 -> 城市 -> 学校数，内容不变时地址不变
+        """
+        digest, _ = get_city_tree_asset()
+        return Response(data={
+            "hash": digest,
+            "url": request.build_absolute_uri(reverse("city-tree-asset", kwargs={"digest": digest})),
+        })
+
+    @action(detail=False, methods=["get"], url_path=r"tree/(?P<digest>[0-9a-f]+)", url_name="tree-asset")
+    def tree_asset(self, request, digest, *args, **kwargs):
+        current, name = get_city_tree_asset()
+        if digest != current:
+            raise NotFound()
+        return serve_file(request, name, "application/json", digest, "public, max-age=31536000, immutable")
+
+    @action(detail=False, methods=["get"])
+    def locate(self, request, *args, **kwargs):
+        """
+        逆地理编码：?lon=&lat= 所在的城市，在进程内用城市边界计算，不依赖外部服务
+        """
+        try:
+            lon, lat = float(request.query_params["lon"]), float(request.query_params["lat"])
+            if not (math.isfinite(lon) and math.isfinite(lat)):
+                raise ValueError
+        except (KeyError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["lon 和 lat 必须是数字"]})
+        city = get_reference().city_by_adcode.get(get_city_index().locate(lon, lat))
+        if city is None:
+            raise NotFound()
+        return Response(data=self.get_serializer(city).data)
+
+
+def parse_accept_encoding(header):
+    """
+    :return: 客户端接受的压缩方式，不包括 q=0 的
+    """
+    accepted = set()
+    for item in header.split(","):
+        encoding, _, params = item.partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def serve_file(request, name, content_type, etag, cache_control):
+    """
+    发送存储中的文件：选择客户端接受的预压缩版本并处理条件请求（If-None-Match, If-Modified-Since）
+    配置了 SENDFILE_HEADER 时只返回文件位置，由前端服务器发送，不占用 Python 进程。nginx 的配置：
+        location /protected/ { internal; alias <MEDIA_ROOT>/; }
+    :param name: 存储中的文件名
+    :param etag: 文件内容的标识，不带引号，压缩版本会加上压缩方式作为后缀
+    :param cache_control: Cache-Control 头
+    """
+    accepted = parse_accept_encoding(request.headers.get("Accept-Encoding", ""))
+    for encoding in get_encodings():
+        if encoding in accepted and default_storage.exists(name + ENCODINGS[encoding]):
+            name += ENCODINGS[encoding]
+            etag = f'"{etag}-{encoding}"'
+            break
+    else:
+        encoding = None
+        etag = f'"{etag}"'
+    last_modified = int(default_storage.get_modified_time(name).timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if settings.SENDFILE_HEADER == "X-Accel-Redirect":
+            response = HttpResponse(content_type=content_type)
+            response["X-Accel-Redirect"] = settings.SENDFILE_URL + quote(name)
+        elif settings.SENDFILE_HEADER:
+            response = HttpResponse(content_type=content_type)
+            response[settings.SENDFILE_HEADER] = default_storage.path(name)
+        else:
+            response = FileResponse(default_storage.open(name), content_type=content_type)
+        if encoding is not None:
+            response["Content-Encoding"] = encoding
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = cache_control
+    patch_vary_headers(response, ["Accept-Encoding"])
+    return response
+
+
+def get_map_content_type(fmt):
+    return TopoJSONRenderer.media_type if fmt == "topojson" else "application/json"
+
+
+def get_map_detail(request):
+    """
+    :return: 请求的细节等级，不合法时返回 None
+    """
+    detail = request.query_params.get("detail", settings.MAP_DEFAULT_DETAIL)
+    if detail not in settings.MAP_DETAILS:
+        return None
+    return detail
+
+
+def get_base_map_manifest(request, detail, fmt="geojson"):
+    """
+    底图尚未生成时提交后台任务，此时 hash 和 url 为 None，state 为任务状态
+    """
+    key = base_map_cache_key(detail, fmt)
+    asset = find_base_map_asset(detail, fmt)
+    if asset is None:
+        jobs.submit(key, get_base_map_asset, detail, fmt)
+        asset = find_base_map_asset(detail, fmt)
+    digest = asset[0] if asset is not None else None
+    return {
+        "detail": detail,
+        "format": fmt,
+        "hash": digest,
+        "url": request.build_absolute_uri(
+            reverse("map-base-asset", kwargs={"detail": detail, "digest": digest})
+        ) if digest is not None else None,
+        "state": jobs.get_status(key),
+    }
+
+
+def get_district_map_manifest(request, adcode, detail, fmt="geojson"):
+    """
+    同 get_base_map_manifest，adcode 需要事先用 get_district_children 检查
+    """
+    key = district_map_cache_key(adcode, detail, fmt)
+    asset = find_district_map_asset(adcode, detail, fmt)
+    if asset is None:
+        jobs.submit(key, get_district_map_asset, adcode, detail, fmt)
+        asset = find_district_map_asset(adcode, detail, fmt)
+    digest = asset[0] if asset is not None else None
+    return {
+        "adcode": adcode,
+        "detail": detail,
+        "format": fmt,
+        "hash": digest,
+        "url": request.build_absolute_uri(reverse("map-district-asset", kwargs={
+            "adcode": adcode, "detail": detail, "digest": digest
+        })) if digest is not None else None,
+        "state": jobs.get_status(key),
+    }
+
+
+def manifest_response(manifest):
+    """
+    文件尚未生成时返回 202，客户端稍后重新请求
+    """
+    return Response(
+        data=manifest,
+        status=status.HTTP_200_OK if manifest["url"] is not None else status.HTTP_202_ACCEPTED,
+        content_type="application/json"
+    )
+
+
+class MapViewSet(viewsets.ViewSet):
+    """
+    与班级无关的地图数据，?format=topojson 或 Accept: application/topo+json 时使用 TopoJSON
+    """
+    permission_classes = [AllowAny]
+    renderer_classes = MAP_RENDERER_CLASSES
+
+    @action(detail=False, methods=["get"])
+    def base(self, request, *args, **kwargs):
+        detail = get_map_detail(request)
+        if detail is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["detail 不在可选范围内"]})
+        return manifest_response(get_base_map_manifest(request, detail, get_map_format(request)))
+
+    @action(detail=False, methods=["get"], url_path=r"base/(?P<detail>\w+)/(?P<digest>[0-9a-f]+)",
+            url_name="base-asset")
+    def base_asset(self, request, detail, digest, *args, **kwargs):
+        """
+        底图的文件名带有内容哈希，内容不会改变，可以永久缓存
+        只发送已经生成的文件，任意的 digest 不会触发生成
+        """
+        if detail not in settings.MAP_DETAILS:
+            raise NotFound()
+        for fmt in MAP_FORMATS:
+            asset = find_base_map_asset(detail, fmt)
+            if asset is not None and asset[0] == digest:
+                name = asset[1]
+                break
+        else:
+            raise NotFound()
+        return serve_file(request, name, get_map_content_type(fmt), digest, "public, max-age=31536000, immutable")
+
+    @action(detail=False, methods=["get"], url_path=r"districts/(?P<adcode>\d{6})")
+    def district(self, request, adcode, *args, **kwargs):
+        """
+        下钻：单个行政区及其直接下级的边界，首次加载只需要 100000（国家及省级行政区）
+        """
+        detail = get_map_detail(request)
+        if detail is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"errors": ["detail 不在可选范围内"]})
+        if get_district_children(adcode) is None:
+            raise NotFound()
+        return manifest_response(get_district_map_manifest(request, adcode, detail, get_map_format(request)))
+
+    @action(detail=False, methods=["get"], url_path=r"districts/(?P<adcode>\d{6})/(?P<detail>\w+)/(?P<digest>[0-9a-f]+)",
+            url_name="district-asset")
+    def district_asset(self, request, adcode, detail, digest, *args, **kwargs):
+        if detail not in settings.MAP_DETAILS:
+            raise NotFound()
+        for fmt in MAP_FORMATS:
+            asset = find_district_map_asset(adcode, detail, fmt)
+            if asset is not None and asset[0] == digest:
+                name = asset[1]
+                break
+        else:
+            raise NotFound()
+        return serve_file(request, name, get_map_content_type(fmt), digest, "public, max-age=31536000, immutable")